@@ -4,22 +4,100 @@ __version__ = "0.0.14"
 __desc__ = "Automate process of downloading name your price albums from bandcamp."
 
 import argparse
+import hashlib
 import json
 import os
+import queue
 import re
 import shutil
+import signal
+import sqlite3
+import struct
 import sys
+import threading
+import time
+import traceback
+import zlib
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from enum import IntEnum
-from pathlib import Path
-from urllib.parse import unquote, urljoin, urlparse
+from html import unescape
+from urllib.parse import parse_qs, unquote, urljoin, urlparse
 
-import requests
-from selenium import webdriver
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Only exceptions are imported right away. The rest of selenium, requests and asyncio take most of
+# startup time, so they are imported only when browser, network or event loop is actually used.
 from selenium.common.exceptions import *
-from selenium.webdriver.common.by import By
-from selenium.webdriver.firefox.firefox_profile import FirefoxProfile
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import Select, WebDriverWait
+
+BLOCKED_URL_PATTERNS = (
+    "*.woff",
+    "*.woff2",
+    "*.ttf",
+    "*.otf",
+    "*.mp3",
+    "*.mp4",
+    "*.ogg",
+    "*.jpg",
+    "*.png",
+    "*.gif",
+    "*bcbits.com/stream/*",
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+    "*doubleclick.net*",
+    "*facebook.net*",
+    "*facebook.com*",
+    "*twitter.com*",
+    "*quantserve.com*",
+    "*scorecardresearch.com*",
+)
+MINIMAL_CHROME_ARGUMENTS = (
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--disable-domain-reliability",
+    "--disable-client-side-phishing-detection",
+    "--no-first-run",
+    "--mute-audio",
+    "--autoplay-policy=user-gesture-required",
+    "--disk-cache-size=1",
+    "--media-cache-size=1",
+    "--aggressive-cache-discard",
+)
+MINIMAL_CHROME_PREFERENCES = {
+    "profile.managed_default_content_settings.images": 2,
+    "profile.managed_default_content_settings.plugins": 2,
+    "profile.managed_default_content_settings.notifications": 2,
+}
+MINIMAL_FIREFOX_PREFERENCES = {
+    "browser.display.use_document_fonts": 0,
+    "gfx.downloadable_fonts.enabled": False,
+    "media.autoplay.default": 5,
+    "media.mp4.enabled": False,
+    "media.ogg.enabled": False,
+    "media.webm.enabled": False,
+    "browser.cache.disk.enable": False,
+    "browser.cache.memory.enable": False,
+    "browser.cache.offline.enable": False,
+    "network.prefetch-next": False,
+    "network.dns.disablePrefetch": True,
+    "network.http.speculative-parallel-limit": 0,
+    "browser.safebrowsing.malware.enabled": False,
+    "browser.safebrowsing.phishing.enabled": False,
+    "extensions.update.enabled": False,
+    "app.update.enabled": False,
+    "app.update.auto": False,
+    "datareporting.healthreport.uploadEnabled": False,
+    "datareporting.policy.dataSubmissionEnabled": False,
+    "toolkit.telemetry.enabled": False,
+    "privacy.trackingprotection.enabled": True,
+}
 
 drivers = (
     "chromium",
@@ -33,12 +111,52 @@ drivers = (
     "webkit",
 )
 
+encodings = ("mp3", "mp3v0", "flac", "aac", "ogg", "alac", "wav", "aiff")
+
 
 class ExitCodes(IntEnum):
     SUCCESS = 0
     UNDOWNLOADABLE = 1
     EMAIL_UNSPECIFIED = 2
     CACHE_CORRUPTED = 3
+    FILE_CORRUPTED = 4
+
+
+DOWNLOAD_ATTEMPTS = 3
+BROWSER_LAUNCH_ATTEMPTS = 3
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+PART_FILE_SUFFIX = ".part"
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+# Progress of segment is saved to cache every time that many bytes of it are downloaded
+SEGMENT_PROGRESS_SIZE = 16 * 1024 * 1024
+# Download urls expiring sooner than that are considered expired
+DOWNLOAD_URL_EXPIRY_MARGIN = 10 * 60
+MIN_POLL_INTERVAL = 0.05
+# Responses telling that host is overloaded or that requests are sent to it too fast
+THROTTLING_STATUS_CODES = (429, 500, 502, 503, 504)
+# Titles of pages, which are shown instead of requested one to clients suspected to be bots
+CHALLENGE_PAGE_TITLE_PATTERN = re.compile(
+    r"<title>\s*(just a moment|attention required|.*captcha|are you a robot)", re.IGNORECASE
+)
+# Album url, which was given without scheme: bandcamp host or any host with album or track path
+SCHEMELESS_ALBUM_URL_PATTERN = re.compile(
+    r"(?:[\w-]+\.)*bandcamp\.com(?:[/:]|$)|(?:[\w-]+\.)+[a-z]{2,}(?::\d+)?/(?:album|track)/",
+    re.IGNORECASE,
+)
+MIN_REQUEST_RATE = 0.1
+# Requests per second added to rate of throttling host with every healthy response
+REQUEST_RATE_STEP = 0.5
+
+
+class AbortAlbum(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+# Raised, when bandcamp asks for email, and album should be resolved later
+class EmailRequested(Exception):
+    pass
 
 
 def main():
@@ -47,17 +165,27 @@ def main():
         description=__desc__,
     )
     parser.add_argument(
-        "album_url",
+        "album_urls",
         metavar="ALBUM_URL",
         type=str,
-        help="url of desired bandcamp album",
+        nargs="*",
+        help="url of desired bandcamp album (several urls may be specified)",
     )
     parser.add_argument(
-        "download_dir",
+        "download_dir_positional",
         metavar="DOWNLOAD_DIR",
         type=str,
         nargs="?",
-        help="directory to download album to",
+        default=argparse.SUPPRESS,
+        help="directory to download album to (last positional argument, if it is not an url)",
+    )
+    parser.add_argument(
+        "--input-file",
+        "-i",
+        metavar="FILE",
+        type=str,
+        action="append",
+        help="read album urls from file, one per line ('-' to read from stdin)",
     )
     parser.add_argument(
         "--download-dir",
@@ -70,9 +198,10 @@ def main():
         "-e",
         "--format",
         "-f",
-        type=str,
-        choices=("mp3", "mp3v0", "flac", "aac", "ogg", "alac", "wav", "aiff"),
-        help="desired encoding",
+        metavar="ENCODING[,ENCODING...]",
+        type=parse_encodings,
+        help=f"desired encoding ({', '.join(encodings)}) or several comma-separated encodings,"
+        " all of which are downloaded after a single checkout",
     )
     parser.add_argument(
         "--skip-nyp-check",
@@ -94,12 +223,149 @@ def main():
         default=60,
         help="period to wait for bandcamp preparing download (in seconds) (default is 60)",
     )
+    parser.add_argument(
+        "--poll-interval",
+        metavar="SECONDS",
+        type=float,
+        default=0.5,
+        help="maximum interval of polling browser, when waiting for element can't be done with"
+        " javascript (in seconds) (default is 0.5)",
+    )
+    parser.add_argument(
+        "--print-wait-times",
+        action="store_true",
+        help="print statistics of time spent waiting for pages and download preparing",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        metavar="FILE",
+        type=str,
+        help="write timings of stages, downloaded bytes, throughput, retries and outcome of every"
+        " album to file",
+    )
+    parser.add_argument(
+        "--metrics-format",
+        choices=("jsonl", "prometheus"),
+        default="jsonl",
+        help="format of metrics file: a json object per album appended to file, or totals of run"
+        " in prometheus text format (default is jsonl)",
+    )
     parser.add_argument(
         "--driver",
         "--webdriver",
         choices=drivers,
         help="desired webdriver (default is chromium)",
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        metavar="N",
+        type=int,
+        default=1,
+        help="number of albums scraped in parallel, each one in its own browser (default is 1)",
+    )
+    parser.add_argument(
+        "--download-jobs",
+        metavar="N",
+        type=int,
+        default=2,
+        help="number of files downloaded in parallel while scraping goes on (default is 2)",
+    )
+    parser.add_argument(
+        "--async-downloads",
+        action="store_true",
+        help="download files concurrently on a single asyncio event loop (requires aiohttp)"
+        " instead of a thread per download; --download-jobs sets number of transfers in flight",
+    )
+    parser.add_argument(
+        "--connections-per-host",
+        metavar="N",
+        type=int,
+        default=8,
+        help="maximum number of connections to a single host with --async-downloads (default is 8)",
+    )
+    parser.add_argument(
+        "--bandwidth-limit",
+        metavar="BYTES",
+        type=parse_size,
+        help="maximum total download speed in bytes per second with --async-downloads (K, M and G"
+        " suffixes are supported)",
+    )
+    parser.add_argument(
+        "--connections",
+        metavar="N",
+        type=int,
+        default=1,
+        help="number of parallel connections used to download a single large file (default is 1)",
+    )
+    parser.add_argument(
+        "--http-retries",
+        metavar="N",
+        type=int,
+        default=3,
+        help="number of retries of failed http requests (default is 3)",
+    )
+    parser.add_argument(
+        "--max-request-rate",
+        metavar="N",
+        type=float,
+        help="maximum number of requests per second sent to every host by all jobs together"
+        " (default is no limit); when host throttles requests (responds with 429 or 5xx status"
+        " or a challenge page), rate of requests to it is halved, and it is raised back while"
+        " its responses are healthy",
+    )
+    parser.add_argument(
+        "--http-timeout",
+        metavar="SECONDS",
+        type=int,
+        default=30,
+        help="timeout of http connections and reads (in seconds) (default is 30)",
+    )
+    parser.add_argument(
+        "--checksum",
+        metavar="ALGORITHM",
+        choices=("md5", "sha1", "sha256", "sha512", "blake2b"),
+        help="compute hash of downloaded file while downloading it and keep it in cache (md5, sha1,"
+        " sha256, sha512 or blake2b)",
+    )
+    parser.add_argument(
+        "--verify-files",
+        action="store_true",
+        help="check hashes of already downloaded files before skipping them (only sizes are"
+        " checked otherwise)",
+    )
+    parser.add_argument(
+        "--extract",
+        action="store_true",
+        help="extract downloaded zip archive into directory named after it while downloading it",
+    )
+    parser.add_argument(
+        "--browser-only",
+        action="store_true",
+        help="always scrape album page in browser instead of trying to resolve download url with"
+        " plain http requests first",
+    )
+    parser.add_argument(
+        "--minimal-browser",
+        action="store_true",
+        help="don't load images, fonts, media and third-party scripts, disable browser cache,"
+        " extensions and background networking, and use page as soon as it is parsed",
+    )
+    parser.add_argument(
+        "--recycle-after",
+        metavar="N",
+        type=int,
+        default=50,
+        help="number of albums, after which browser is restarted to free memory leaked by it"
+        " (default is 50)",
+    )
+    parser.add_argument(
+        "--max-browser-memory",
+        metavar="BYTES",
+        type=parse_size,
+        help="restart browser after album, if its processes use more memory (K, M and G suffixes"
+        " are supported) (is only checked on Linux)",
+    )
     parser.add_argument(
         "--show-browser-window",
         action="store_true",
@@ -122,11 +388,34 @@ def main():
         help="don't skip downloading if desired file already exists in current directory or was"
         " already downloaded",
     )
+    parser.add_argument(
+        "--library",
+        metavar="DIR",
+        type=str,
+        action="append",
+        help="directory with already downloaded albums, which is indexed, so that albums are found"
+        " there without scraping, even if their files were moved or renamed (may be specified"
+        " several times)",
+    )
     parser.add_argument(
         "--ignore-cache",
         action="store_true",
         help="don't load cache and don't write anything to it",
     )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and process album urls enqueued with http api (specified album urls are"
+        " enqueued too); jobs are kept in cache, so unfinished ones are resumed after restart",
+    )
+    parser.add_argument(
+        "--listen",
+        metavar="ADDRESS",
+        type=str,
+        default="127.0.0.1:8770",
+        help="address (HOST:PORT or path of unix socket) of http api of daemon (default is"
+        " 127.0.0.1:8770)",
+    )
     parser.add_argument(
         "--email",
         type=str,
@@ -145,83 +434,51 @@ def main():
         type=str,
         help="postal code used if bandcamp asks for email",
     )
-    args = parser.parse_args(sys.argv[1:])
-
-    album_url = remove_url_query_parameters(args.album_url)
-    cover_url = None
-    download_url = None
-    local_file_name = None
-    driver = None
-
-    def finish_and_exit(code):
-        if driver:
-            driver.close()
-            driver.quit()
-        exit(code)
-
-    # Load cache
-    if not args.ignore_cache:
-        import standardpaths
-
-        loaded_cache = []
-
-        def overwrite_cache():
-            with open(cache_file, "w") as f:
-                json.dump(loaded_cache, f)
+    args = parser.parse_intermixed_args(sys.argv[1:])
+    # intermixed parsing fills positionals after options, so DOWNLOAD_DIR has its own dest to not
+    # overwrite --download-dir
+    if args.download_dir is None:
+        args.download_dir = getattr(args, "download_dir_positional", None)
 
-        def ask_to_overwrite_cache():
-            if ask_yes_no("Cache seems corrupted. Overwrite?"):
-                overwrite_cache()
-                return True
-            else:
-                return False
+    # DOWNLOAD_DIR is consumed by ALBUM_URL, because the latter accepts any number of arguments
+    if (
+        args.download_dir is None
+        and (len(args.album_urls) > 1 or (args.album_urls and (args.input_file or args.daemon)))
+        and not is_url(args.album_urls[-1])
+    ):
+        if SCHEMELESS_ALBUM_URL_PATTERN.match(args.album_urls[-1]):
+            parser.error(
+                f"'{args.album_urls[-1]}' looks like album url without http(s)://, not download"
+                " directory (specify download directory with --download-dir)"
+            )
+        args.download_dir = args.album_urls.pop()
 
-        standardpaths.configure(application_name="bandcamp_name_your_price_dl")
-        cache_dir = standardpaths.get_writable_path("cache")
-        os.makedirs(cache_dir, exist_ok=True)
-        cache_file = os.path.join(cache_dir, "cache.json")
-        Path(cache_file).touch()
+    album_urls = list(args.album_urls)
+    for input_file in args.input_file or ():
+        album_urls.extend(read_album_urls(input_file))
+    album_urls = deduplicate_album_urls(album_urls)
+    if not album_urls and not args.daemon:
+        parser.error("no album urls specified")
+    if args.daemon and args.ignore_cache:
+        parser.error("daemon keeps its jobs in cache, so it can't be run with --ignore-cache")
+    if args.daemon:
         try:
-            with open(cache_file) as f:
-                s = f.read()
-                if len(s):
-                    loaded_cache = json.loads(s)
-        except json.JSONDecodeError as e:
-            eprint(e.msg)
-            if not ask_to_overwrite_cache():
-                exit(ExitCodes.CACHE_CORRUPTED)
-    else:
-        loaded_cache = []
-
-    def write_cache():
-        if not args.ignore_cache:
-            cache_entry["album_url"] = album_url
-            if cache_entry not in loaded_cache:
-                loaded_cache.append(cache_entry)
-            with open(cache_file, "w") as f:
-                json.dump(loaded_cache, f)
+            parse_listen_address(args.listen)
+        except ValueError:
+            parser.error(f"invalid address to listen on: '{args.listen}' (expected HOST:PORT or path)")
+    if args.max_request_rate is not None and args.max_request_rate <= 0:
+        parser.error("--max-request-rate must be positive")
+    if args.library and args.ignore_cache:
+        parser.error("library index is kept in cache, so it can't be used with --ignore-cache")
+    if args.jobs < 1 or args.download_jobs < 1 or args.connections < 1:
+        parser.error("number of jobs must be positive")
+    if args.recycle_after < 1:
+        parser.error("number of albums browser is restarted after must be positive")
+    if args.async_downloads:
+        import importlib.util
 
-    # Search for entry with desired url in cache
-    # If not found, create a new entry
-
-    for entry in loaded_cache:
-        if remove_url_query_parameters(entry["album_url"]) == album_url:
-            try:
-                if "downloadable" in entry.keys() and not entry["downloadable"]:
-                    eprint("Album marked as undownloadable in cache. Aborting.")
-                    exit(ExitCodes.UNDOWNLOADABLE)
-                download_url = entry["download_url"]
-                local_file_name = entry["local_file_name"]
-                cache_entry = entry
-                loaded_cache.remove(entry)
-                break
-            except KeyError as e:
-                eprint(e.msg)
-                if not ask_to_overwrite_cache():
-                    exit(ExitCodes.CACHE_CORRUPTED)
-    else:
-        loaded_cache.append({"album_url": album_url})
-        cache_entry = loaded_cache[-1]
+        if importlib.util.find_spec("aiohttp") is None:
+            parser.error("aiohttp is required for --async-downloads")
 
     if not args.download_dir:
         download_dir = os.path.curdir
@@ -229,302 +486,2968 @@ def main():
         download_dir = args.download_dir
     download_dir = os.path.abspath(download_dir)
 
-    if local_file_name is not None:
-        file_exists_in_initial_file_path = os.path.exists(local_file_name)
-        download_directory_file_name = os.path.join(
-            download_dir, os.path.split(local_file_name)[-1]
+    cache = Cache(args.ignore_cache)
+    if args.library:
+        eprint("Indexing library...")
+        update_file_index(cache, [os.path.abspath(directory) for directory in args.library])
+    wait_times = WaitTimes()
+    metrics_writer = MetricsWriter(args.metrics_file, args.metrics_format)
+    if args.daemon:
+        try:
+            run_daemon(album_urls, args, cache, download_dir, wait_times, metrics_writer)
+        finally:
+            metrics_writer.close()
+        if args.print_wait_times:
+            wait_times.print_summary()
+        exit(ExitCodes.SUCCESS)
+    try:
+        results = process_album_urls(
+            album_urls, args, cache, download_dir, wait_times, metrics_writer
         )
-        file_exists_in_download_dir = os.path.exists(download_directory_file_name)
-    else:
-        file_exists_in_initial_file_path = False
-        file_exists_in_download_dir = False
+    finally:
+        metrics_writer.close()
+    if args.print_wait_times:
+        wait_times.print_summary()
 
-    actions_needed = (
-        (not file_exists_in_initial_file_path and not file_exists_in_download_dir)
-        or args.dont_skip_if_file_exists
-        or args.print_url
-    )
+    if len(results) > 1:
+        eprint("Results:")
+        for album_url, code in results:
+            eprint(f"{code.name}: {album_url}")
+    exit(max((code for _, code in results), default=ExitCodes.UNDOWNLOADABLE))
 
-    if not actions_needed:
-        if file_exists_in_initial_file_path:
-            file_name_to_print = local_file_name
-        else:
-            file_name_to_print = download_directory_file_name
-        eprint(
-            f"File exists in '{file_name_to_print}'. Skipping scraping and downloading.",
-            "Rerun program with --dont-skip-if-file-exists to redownload.",
-        )
-        finish_and_exit(ExitCodes.SUCCESS)
 
-    if (
-        args.dont_skip_scraping
-        or download_url is None
-        or requests.get(download_url, stream=True).status_code != 200
-    ):
-        if args.encoding is not None:
-            if args.encoding == "mp3":
-                onsite_encoding = "mp3-320"
-            elif args.encoding == "mp3v0":
-                onsite_encoding = "mp3-v0"
-            elif args.encoding == "ogg":
-                onsite_encoding = "vorbis"
-            elif args.encoding == "aac":
-                onsite_encoding = "aac-hi"
-            elif args.encoding == "aiff":
-                onsite_encoding = "aiff-lossless"
-            else:
-                onsite_encoding = args.encoding
-        else:
-            onsite_encoding = None
-
-        if args.driver is None:
-            args.driver = "chromium"
-        if args.driver in ("chrome", "chromium"):
-            options = webdriver.ChromeOptions()
-            if not args.show_browser_window:
-                options.add_argument("--headless")
-                options.add_argument("--disable-gpu")
-            options.add_argument("--blink-settings=imagesEnabled=false")
-            driver = webdriver.Chrome(options=options)
-        elif args.driver == "edge":
-            driver = webdriver.Edge()
-        elif args.driver in ("firefox", "gecko"):
-            profile = FirefoxProfile()
-            profile.set_preference("permissions.default.image", 2)
-            if not args.show_browser_window:
-                os.environ["MOZ_HEADLESS"] = "1"
-            driver = webdriver.Firefox(profile, service_log_path=os.devnull)
-        elif args.driver == "opera":
-            driver = webdriver.Opera()
-        elif args.driver == "phantomjs":
-            driver = webdriver.PhantomJS()
-        elif args.driver == "safari":
-            driver = webdriver.Safari()
-        elif args.driver == "webkit":
-            driver = webdriver.WebKitGTK()
+class IncompleteDownload(IOError):
+    pass
 
-        check_if_album_is_name_your_price = not args.skip_nyp_check
-        page_load_wait_time = args.wait_time
-        preparing_wait_time = args.preparing_wait_time
-        email_address = args.email
-        country_abbrev = args.country_abbrev
-        postal_code = args.postal_code
 
-        eprint(f"Opening '{album_url}'...")
-        driver.get(album_url)
+def process_album_urls(album_urls, args, cache, download_dir, wait_times, metrics_writer):
+    results = [None] * len(album_urls)
 
-        # Check if album is free download
-        try:
-            direct_free_download_button = driver.find_element(
-                By.XPATH,
-                "//button[@class='download-link buy-link'][text()='Free Download']"
-            )
-            direct_free_download_button.click()
-        except NoSuchElementException:
-            # Check if album is name your price
-            try:
-                if (
-                    check_if_album_is_name_your_price
-                    and driver.find_element(
-                        By.XPATH,
-                        "//span[@class='buyItemExtra buyItemNyp secondaryText']"
-                    ).text
-                    != "name your price"
-                ):
-                    eprint("Album is not name your price. Aborting.")
-                    cache_entry["downloadable"] = False
-                    write_cache()
-                    finish_and_exit(ExitCodes.UNDOWNLOADABLE)
-            except NoSuchElementException:
-                eprint(
-                    "Element indicating if is album name your price not found. Aborting."
-                )
-                cache_entry["downloadable"] = False
-                write_cache()
-                finish_and_exit(ExitCodes.UNDOWNLOADABLE)
+    def finish(i, code, metrics):
+        results[i] = (album_urls[i], code)
+        metrics_writer.write(metrics, code)
 
-            is_track = False
-            try:
-                driver.find_element(
-                    By.XPATH,
-                    "//*[@id='track_table']"
-                )
-            except NoSuchElementException:
-                is_track = True
+    pipeline = Pipeline(args, cache, download_dir, wait_times, finish, album_count=len(album_urls))
+    try:
+        for i, album_url in enumerate(album_urls):
+            pipeline.put(i, album_url, args.print_url)
+        pipeline.close()
+    except KeyboardInterrupt:
+        pipeline.interrupt()
+        raise
 
-            if is_track:
-                try:
-                    cover_url = driver.find_element(
-                        By.XPATH,
-                        "//*[@id='tralbumArt']/a"
-                    ).get_attribute("href").replace("_10", "_0")
-                except NoSuchElementException:
-                    eprint("Track cover image not found.")
+    return [result for result in results if result is not None]
 
-            try:
-                buy_link = driver.find_element(
-                    By.XPATH,
-                    "//button[@class='download-link buy-link']"
-                )
-                buy_link.click()
-            except NoSuchElementException:
-                eprint("'Buy Digital Album' link not found. Aborting.")
-                cache_entry["downloadable"] = False
-                write_cache()
-                finish_and_exit(ExitCodes.UNDOWNLOADABLE)
 
-            price_input_filled = driver.find_element(
-                By.XPATH,
-                "//input[@class='display-price numeric']"
+# Scraping and downloading are separate stages: scrapers only resolve download urls and pass
+# them to downloaders, so that browsers don't sit idle while files are being downloaded.
+# Every scraper takes next album as soon as it is done with previous one, so a slow album doesn't
+# block others. Albums, for which bandcamp asks for email, are deferred to a separate queue, so
+# that waiting for link from email doesn't block scrapers. Albums are identified by keys, which
+# are passed to finish and set_status callbacks.
+class Pipeline:
+    def __init__(
+        self, args, cache, download_dir, wait_times, finish, set_status=None, album_count=None
+    ):
+        self.finish = finish
+        self.set_status = set_status or (lambda key, status: None)
+        self.album_url_queue = queue.Queue()
+        self.deferred_queue = queue.Queue()
+        self.download_queue = queue.Queue()
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        # Number of downloads left and greatest exit code of albums being downloaded
+        self.pending_downloads = {}
+        # Requests of all workers are paced together, so that bandcamp isn't flooded with them
+        rate_controller = RateController(args.max_request_rate)
+        # Single session is shared by all workers, so that connections to bandcamp hosts are kept
+        # alive and reused between albums
+        session = LazySession(
+            args.jobs + args.connections * args.download_jobs,
+            args.http_retries,
+            args.http_timeout,
+            rate_controller,
+        )
+        scraper_count = min(args.jobs, album_count or args.jobs)
+        self.browser_pool = BrowserPool(args, scraper_count, self.album_url_queue)
+        # Browsers are certainly needed, only if albums aren't resolved with http requests.
+        # Otherwise they are launched on demand.
+        if args.browser_only:
+            self.browser_pool.prelaunch()
+
+        self.scrapers = [
+            threading.Thread(
+                target=self.scraper,
+                args=(
+                    AlbumDownloader(
+                        args,
+                        cache,
+                        download_dir,
+                        session,
+                        wait_times,
+                        self.browser_pool,
+                        rate_controller,
+                    ),
+                ),
             )
-            price_input_filled.clear()
-            price_input_filled.send_keys("0")
+            for _ in range(scraper_count)
+        ]
+        self.deferred_scraper = threading.Thread(
+            target=self.resolve_deferred,
+            args=(
+                AlbumDownloader(
+                    args,
+                    cache,
+                    download_dir,
+                    session,
+                    wait_times,
+                    self.browser_pool,
+                    rate_controller,
+                ),
+            ),
+        )
+        if args.async_downloads:
+            import asyncio
 
-            free_download_link = WebDriverWait(driver, page_load_wait_time).until(
-                EC.visibility_of_element_located(
-                    (By.XPATH, "//a[@class='download-panel-free-download-link']")
+            # All downloads are run concurrently on a single event loop instead
+            self.downloaders = [
+                threading.Thread(
+                    target=asyncio.run,
+                    args=(
+                        AsyncDownloader(args, cache, download_dir, rate_controller).run(
+                            self.download_queue, self.finish_download
+                        ),
+                    ),
                 )
-            )
-            free_download_link.click()
+            ]
+        else:
+            self.downloaders = [
+                threading.Thread(
+                    target=self.downloader,
+                    args=(
+                        AlbumDownloader(
+                            args, cache, download_dir, session, wait_times, None, rate_controller
+                        ),
+                    ),
+                )
+                # Album may have several download jobs (one for every encoding), so the number of
+                # downloaders isn't limited by the number of albums
+                for _ in range(args.download_jobs)
+            ]
+        for thread in self.scrapers + [self.deferred_scraper] + self.downloaders:
+            thread.start()
 
-            # Handle bandcamp asking for email
+    def put(self, key, album_url, print_url=False):
+        self.album_url_queue.put((key, album_url, print_url))
+
+    def scraper(self, downloader):
+        while True:
+            item = self.album_url_queue.get()
+            if item is None or self.stop.is_set():
+                break
+            key, album_url, print_url = item
+            self.set_status(key, "resolving")
             try:
-                # Check if element is interactable first to exit try block immediately if it is not
-                # present
-                email_input = driver.find_element(
-                    By.XPATH,
-                    "//*[@id='fan_email_address']"
-                )
-                email_input.send_keys(str(email_address))
+                result = downloader.resolve(album_url, print_url)
+            except EmailRequested:
+                eprint(f"Bandcamp asked for email for '{album_url}'. Deferring it...")
+                self.set_status(key, "deferred")
+                self.deferred_queue.put(item)
+                continue
+            except Exception:
+                print_unexpected_error(album_url)
+                result = ExitCodes.UNDOWNLOADABLE
+            self.pass_on(key, result, downloader)
 
-                asked_for_email = True
-                if email_address is None or postal_code is None:
-                    eprint(
-                        "Bandcamp asked for email, but no email address or postal code specified."
-                        " Aborting."
-                    )
-                    finish_and_exit(ExitCodes.EMAIL_UNSPECIFIED)
-                if country_abbrev is not None:
-                    country_dropdown_list = Select(
-                        driver.find_element(By.XPATH, "//*[@id='fan_email_country']")
-                    )
-                    country_dropdown_list.select_by_value(country_abbrev.upper())
-                postal_code_input = driver.find_element(
-                    By.XPATH,
-                    "//*[@id='fan_email_postalcode']"
-                )
-                postal_code_input.send_keys(postal_code)
-            except ElementNotInteractableException:
-                asked_for_email = False
+    # Deferred albums are resolved one at a time, after all albums put before them are taken by
+    # scrapers. They are scraped once again, because bandcamp may not ask for email anymore, if it
+    # asked only because of too many requests.
+    def resolve_deferred(self, downloader):
+        while True:
+            item = self.deferred_queue.get()
+            if item is None or self.stop.is_set():
+                break
+            while not self.album_url_queue.empty() and not self.stop.wait(1):
+                pass
+            if self.stop.is_set():
+                break
+            key, album_url, print_url = item
+            self.set_status(key, "resolving")
+            try:
+                result = downloader.resolve(album_url, print_url, email_allowed=True)
+            except Exception:
+                print_unexpected_error(album_url)
+                result = ExitCodes.UNDOWNLOADABLE
+            self.pass_on(key, result, downloader)
 
-            checkout_button = driver.find_element(
-                By.XPATH,
-                "//button[@class='download-panel-checkout-button']"
-            )
-            # Selenium thinks that checkout button is invisible and refuses to click it, so it is
-            # clicked with JavaScript
-            driver.execute_script("arguments[0].click();", checkout_button)
+    # Every encoding of album is downloaded by its own download job, so that they are downloaded
+    # concurrently
+    def pass_on(self, key, result, downloader):
+        if isinstance(result, list):
+            self.set_status(key, "downloading")
+            with self.lock:
+                self.pending_downloads[key] = [len(result), ExitCodes.SUCCESS]
+            for download_job in result:
+                self.download_queue.put((key, download_job))
+        else:
+            self.finish(key, result, downloader.metrics)
 
-            if asked_for_email:
-                eprint(
-                    f"An email with download link has been sent to {email_address}.",
-                    "Paste link here to continue: ",
-                )
-                link_from_email = input()
-                driver.get(link_from_email)
-            else:
-                WebDriverWait(driver, page_load_wait_time).until(
-                    lambda driver: driver.current_url != album_url
-                )
+    def downloader(self, downloader):
+        while True:
+            item = self.download_queue.get()
+            if item is None or self.stop.is_set():
+                break
+            key, download_job = item
+            try:
+                code = downloader.download(download_job)
+            except Exception:
+                print_unexpected_error(download_job.album_url)
+                code = ExitCodes.UNDOWNLOADABLE
+            self.finish_download(key, code, download_job.metrics)
 
-        # Choose encoding from dropdown list
-        if onsite_encoding is not None:
-            encoding_dropdown_button = WebDriverWait(driver, page_load_wait_time).until(
-                EC.visibility_of_element_located(
-                    (
-                        By.XPATH,
-                        "//*[@id='format-type']",
-                    )
-                )
-            )
-            encoding_dropdown_button.click()
+    # Album is finished, when all its downloads are finished
+    def finish_download(self, key, code, metrics):
+        with self.lock:
+            pending_download = self.pending_downloads[key]
+            pending_download[0] -= 1
+            pending_download[1] = max(pending_download[1], code)
+            if pending_download[0]:
+                return
+            del self.pending_downloads[key]
+        self.finish(key, pending_download[1], metrics)
 
-            format_list_element = driver.find_element(
-                By.XPATH,
-                f"//*[@id='format-type']/option[@value='{onsite_encoding}']"
+    # Waits for all albums put so far to be processed
+    def close(self):
+        for _ in self.scrapers:
+            self.album_url_queue.put(None)
+        for thread in self.scrapers:
+            thread.join()
+        self.deferred_queue.put(None)
+        self.deferred_scraper.join()
+        for _ in self.downloaders:
+            self.download_queue.put(None)
+        for thread in self.downloaders:
+            thread.join()
+        self.browser_pool.close()
 
-            )
-            format_list_element.click()
+    # Waits only for albums in progress
+    def interrupt(self):
+        eprint("Interrupted. Waiting for albums in progress to finish...")
+        self.stop.set()
+        for _ in self.scrapers:
+            self.album_url_queue.put(None)
+        self.deferred_queue.put(None)
+        for _ in self.downloaders:
+            self.download_queue.put(None)
+        for thread in self.scrapers + [self.deferred_scraper] + self.downloaders:
+            thread.join()
+        self.browser_pool.close()
 
-        direct_download_link = WebDriverWait(driver, preparing_wait_time).until(
-            EC.visibility_of_element_located(
-                (By.XPATH, "//*[@id='post-checkout-info']/div[1]/div[2]/div[4]/a[1]")
-            )
+
+# Daemon processes albums enqueued with http api until it is interrupted. Albums in progress are
+# finished before exiting, and albums left in queue are resumed on next start.
+def run_daemon(album_urls, args, cache, download_dir, wait_times, metrics_writer):
+    def finish(job_id, code, metrics):
+        job = cache.get_job(job_id)
+        album_url = remove_url_query_parameters(job["album_url"])
+        cache_entries = [
+            cache.get_entry(album_url, encoding) for encoding in get_onsite_encodings(args.encoding)
+        ]
+        cache.update_job(
+            job_id,
+            status="done",
+            outcome=code.name,
+            exit_code=int(code),
+            download_url=cache_entries[0].get("download_url"),
+            local_file_name=cache_entries[0].get("local_file_name"),
+            downloads=[
+                {
+                    "encoding": cache_entry["encoding"],
+                    "download_url": cache_entry.get("download_url"),
+                    "local_file_name": cache_entry.get("local_file_name"),
+                }
+                for cache_entry in cache_entries
+            ],
         )
+        metrics_writer.write(metrics, code)
 
-        download_url = direct_download_link.get_attribute("href")
-    else:
-        eprint("Active download url exists in cache. Skipping scraping.")
+    def set_status(job_id, status):
+        cache.update_job(job_id, status=status)
 
-    if args.print_url:
-        print(download_url)
-    else:
-        with requests.get(download_url, stream=True) as r:
-            content_disposition_header = r.headers["content-disposition"]
-            on_server_file_name = unquote(re.findall(
-                "filename\*=UTF-8''(.+)", content_disposition_header
-            )[0])
-            local_file_name = os.path.join(download_dir, on_server_file_name)
-            eprint(f"Downloading {'track' if cover_url else 'album'} to '{local_file_name}'...")
-            local_file_exists = os.path.exists(local_file_name)
-            if local_file_exists and not args.dont_skip_if_file_exists:
-                eprint(
-                    f"File, which wasn't downloaded by this program, exists in '{local_file_name}'.",
-                    "Skipping scraping and downloading.",
-                    "Rerun program with --dont-skip-if-file-exists to download and overwrite this file.",
-                )
-                return
-            else:
-                if local_file_exists:
-                    eprint(f"Overwriting '{local_file_name}', because --dont-skip-if-file-exists flag provided.")
-                with open(local_file_name, "wb") as f:
-                    shutil.copyfileobj(r.raw, f)
-
-            if cover_url:
-                with requests.get(cover_url, stream=True) as r:
-                    base_name, _ = os.path.splitext(local_file_name)
-                    cover_file_name = base_name + ".jpg"
-                    eprint(f"Downloading cover to '{cover_file_name}'...")
-                    cover_file_exists = os.path.exists(cover_file_name)
-                    if cover_file_exists and not args.dont_skip_if_file_exists:
-                        eprint(
-                            f"Cover image file (probably not downloaded by this program) already exists in '{cover_file_name}'.",
-                            "Rerun program with --dont-skip-if-file-exists to download and overwrite this file.",
-                        )
-                    else:
-                        if cover_file_exists:
-                            eprint(f"Overwriting '{cover_file_name}', because --dont-skip-if-file-exists flag provided.")
-                        with open(cover_file_name, "wb") as f:
-                            shutil.copyfileobj(r.raw, f)
+    def enqueue(album_url, print_url):
+        job, created = cache.add_job(album_url, print_url)
+        if created:
+            pipeline.put(job["id"], album_url, print_url)
+        return job
 
-    # Add album url, download url and local file name to json file in cache in order to avoid
-    # scraping the page or downloading the album twice
-    if not args.ignore_cache:
-        cache_entry["download_url"] = download_url
-        cache_entry["local_file_name"] = local_file_name
-        write_cache()
+    # Daemon is stopped with SIGTERM the same way as with Ctrl+C
+    def handle_sigterm(signum, frame):
+        raise KeyboardInterrupt
 
-    finish_and_exit(ExitCodes.SUCCESS)
+    # Server is created before workers are started, so that nothing is left running, if address
+    # can't be listened on. Requests are handled only after pipeline is created.
+    try:
+        server = create_api_server(args.listen, cache, enqueue)
+    except OSError as e:
+        eprint(f"Can't listen on '{args.listen}': {e}")
+        exit(ExitCodes.UNDOWNLOADABLE)
+    pipeline = Pipeline(args, cache, download_dir, wait_times, finish, set_status)
+    try:
+        signal.signal(signal.SIGTERM, handle_sigterm)
+        unfinished_jobs = cache.get_jobs(unfinished=True)
+        if unfinished_jobs:
+            eprint(f"Resuming {len(unfinished_jobs)} unfinished jobs...")
+        for job in unfinished_jobs:
+            pipeline.put(job["id"], job["album_url"], job["print_url"])
+        for album_url in album_urls:
+            enqueue(album_url, args.print_url)
+        eprint(f"Listening on {args.listen}...")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Workers are stopped on any error too, because otherwise they would keep process running
+        server.server_close()
+        pipeline.interrupt()
+
+
+def create_api_server(address, cache, enqueue):
+    import socket
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class ApiRequestHandler(BaseHTTPRequestHandler):
+        # GET /jobs[?status=STATUS], GET /jobs/ID
+        def do_GET(self):
+            url = urlparse(self.path)
+            path = url.path.rstrip("/")
+            if path == "/jobs":
+                status = parse_qs(url.query).get("status", [None])[0]
+                self.send_json(200, {"jobs": self.server.cache.get_jobs(status=status)})
+                return
+            match = re.fullmatch(r"/jobs/(\d+)", path)
+            job = self.server.cache.get_job(int(match.group(1))) if match else None
+            if job is None:
+                self.send_json(404, {"error": "not found"})
+            else:
+                self.send_json(200, job)
+
+        # POST /jobs with {"album_urls": [URL, ...], "print_url": BOOL} or {"album_url": URL}.
+        # Album, which is already in queue, isn't enqueued again, and its existing job is returned.
+        def do_POST(self):
+            if urlparse(self.path).path.rstrip("/") != "/jobs":
+                self.send_json(404, {"error": "not found"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))))
+                album_urls = request.get("album_urls") or [request["album_url"]]
+                print_url = bool(request.get("print_url", False))
+            except (ValueError, LookupError, AttributeError, TypeError) as e:
+                self.send_json(400, {"error": f"invalid request: {e!r}"})
+                return
+            if not all(isinstance(album_url, str) and is_url(album_url) for album_url in album_urls):
+                self.send_json(400, {"error": "invalid album url"})
+                return
+            jobs = [self.server.enqueue(album_url, print_url) for album_url in album_urls]
+            self.send_json(201, {"jobs": jobs})
+
+        def send_json(self, status, data):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+
+    class UnixHTTPServer(ThreadingHTTPServer):
+        address_family = socket.AF_UNIX
+
+        # HTTPServer.server_bind expects host and port
+        def server_bind(self):
+            socketserver.TCPServer.server_bind(self)
+            self.server_name = "localhost"
+            self.server_port = 0
+
+    address = parse_listen_address(address)
+    if isinstance(address, str):
+        remove_stale_socket(address)
+        server = UnixHTTPServer(address, ApiRequestHandler)
+    else:
+        server = ThreadingHTTPServer(address, ApiRequestHandler)
+    server.daemon_threads = True
+    server.cache = cache
+    server.enqueue = enqueue
+    return server
+
+
+# Returns path of unix socket or host and port
+def parse_listen_address(address):
+    if "/" in address:
+        return address
+    host, _, port = address.rpartition(":")
+    port = int(port)
+    if not 0 <= port <= 65535:
+        raise ValueError(f"invalid port: {port}")
+    return host or "127.0.0.1", port
+
+
+# Socket left by daemon, which wasn't stopped cleanly, is removed. Anything else at the path,
+# including socket of daemon, which is still running, isn't touched.
+def remove_stale_socket(path):
+    import errno
+    import socket
+    import stat
+
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(errno.EEXIST, "file exists and isn't a socket", path)
+    with socket.socket(socket.AF_UNIX) as s:
+        try:
+            s.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+            return
+    raise OSError(errno.EADDRINUSE, "another daemon is listening on it", path)
+
+
+# File name tag is added to name of downloaded file, if several encodings of album are downloaded
+DownloadJob = namedtuple(
+    "DownloadJob",
+    ("album_url", "cache_entry", "download_url", "cover_url", "metrics", "file_name_tag"),
+)
+
+
+# Cache is an sqlite database with an entry per album and encoding, keyed by album url without
+# query parameters and encoding on bandcamp (which is empty for default encoding). Entries are
+# json objects, so that new fields don't require schema changes.
+class Cache:
+    def __init__(self, ignore_cache):
+        self.ignore_cache = ignore_cache
+        self.connection = None
+        # Cache is shared between workers
+        self.lock = threading.RLock()
+        if ignore_cache:
+            return
+
+        import standardpaths
+
+        standardpaths.configure(application_name="bandcamp_name_your_price_dl")
+        cache_dir = standardpaths.get_writable_path("cache")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_file = os.path.join(cache_dir, "cache.sqlite3")
+        # Other instances of program may be starting at the same time, so recreating corrupted
+        # cache and migrating old one is done under an exclusive lock
+        with file_lock(os.path.join(cache_dir, "cache.lock")):
+            try:
+                self.connect()
+            except sqlite3.DatabaseError as e:
+                eprint(e)
+                if not ask_yes_no("Cache seems corrupted. Overwrite?"):
+                    exit(ExitCodes.CACHE_CORRUPTED)
+                os.remove(self.cache_file)
+                self.connect()
+            self.migrate_json_cache(os.path.join(cache_dir, "cache.json"))
+
+    def connect(self):
+        self.connection = sqlite3.connect(
+            self.cache_file, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        # Write-ahead log lets several instances of program read and write cache at the same time
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # With write-ahead log, commits aren't synced to disk, only checkpoints are. Database stays
+        # consistent, though last commits may be lost on power failure.
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.migrate_to_encodings()
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS albums (album_url TEXT NOT NULL, encoding TEXT NOT NULL,"
+            " entry TEXT NOT NULL, PRIMARY KEY (album_url, encoding))"
+        )
+        # Jobs of daemon. Status is kept in a separate column to look up unfinished jobs quickly.
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs"
+            " (id INTEGER PRIMARY KEY AUTOINCREMENT, status TEXT NOT NULL, job TEXT NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        # Index of files in library. Album url is known for files downloaded by this program.
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, directory TEXT NOT NULL,"
+            " size INTEGER NOT NULL, mtime REAL NOT NULL, hash TEXT, album_url TEXT,"
+            " encoding TEXT NOT NULL DEFAULT '')"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_directory ON files (directory)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_album_url ON files (album_url)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS directories"
+            " (path TEXT PRIMARY KEY, parent TEXT, mtime REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent)"
+        )
+
+    # Entries used to be keyed only by album url. They become entries of default encoding.
+    def migrate_to_encodings(self):
+        album_columns = [row[1] for row in self.connection.execute("PRAGMA table_info(albums)")]
+        if album_columns and "encoding" not in album_columns:
+            with self.transaction():
+                self.connection.execute("ALTER TABLE albums RENAME TO albums_without_encodings")
+                self.connection.execute(
+                    "CREATE TABLE albums (album_url TEXT NOT NULL, encoding TEXT NOT NULL,"
+                    " entry TEXT NOT NULL, PRIMARY KEY (album_url, encoding))"
+                )
+                self.connection.execute(
+                    "INSERT INTO albums SELECT album_url, '', entry FROM albums_without_encodings"
+                )
+                # Entries used to be shared by all encodings, so they are kept for default one and
+                # are copied to encoding of their download url too, so that albums downloaded
+                # with --encoding are still found in cache with it
+                rows = self.connection.execute(
+                    "SELECT album_url, entry FROM albums_without_encodings"
+                ).fetchall()
+                for album_url, entry in rows:
+                    encoding = get_entry_encoding(entry)
+                    if encoding is not None:
+                        self.connection.execute(
+                            "INSERT OR IGNORE INTO albums VALUES (?, ?, ?)",
+                            (album_url, encoding, entry),
+                        )
+                self.connection.execute("DROP TABLE albums_without_encodings")
+        file_columns = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+        if file_columns and "encoding" not in file_columns:
+            self.connection.execute(
+                "ALTER TABLE files ADD COLUMN encoding TEXT NOT NULL DEFAULT ''"
+            )
+
+    # Cache used to be a single json list, which is imported once and renamed
+    def migrate_json_cache(self, json_cache_file):
+        if not os.path.exists(json_cache_file):
+            return
+        loaded_cache = []
+        try:
+            with open(json_cache_file) as f:
+                s = f.read()
+                if len(s):
+                    loaded_cache = json.loads(s)
+        except json.JSONDecodeError as e:
+            eprint(e.msg)
+            if not ask_yes_no("Old cache seems corrupted. Overwrite?"):
+                exit(ExitCodes.CACHE_CORRUPTED)
+        eprint(f"Migrating {len(loaded_cache)} entries from '{json_cache_file}'...")
+        with self.transaction():
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO albums VALUES (?, '', ?)",
+                [
+                    (remove_url_query_parameters(entry["album_url"]), json.dumps(entry))
+                    for entry in loaded_cache
+                    if isinstance(entry, dict) and "album_url" in entry.keys()
+                ],
+            )
+        os.replace(json_cache_file, json_cache_file + ".migrated")
+
+    # Write transaction takes database lock right away, so that entries read in it can't be
+    # changed by other instances of program before transaction is committed
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def read_entry(self, album_url, encoding):
+        row = self.connection.execute(
+            "SELECT entry FROM albums WHERE album_url = ? AND encoding = ?",
+            (album_url, encoding or ""),
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            entry = json.loads(row[0])
+        except json.JSONDecodeError:
+            eprint(f"Cache entry of '{album_url}' is corrupted. Ignoring it.")
+            return None
+        if not isinstance(entry, dict):
+            return None
+        entry["album_url"] = album_url
+        entry["encoding"] = encoding
+        return entry
+
+    # Search for entry with desired url and encoding (None means default one) in cache
+    # If not found, create a new entry, which is added to cache on first write
+    def get_entry(self, album_url, encoding=None):
+        if not self.ignore_cache:
+            with self.lock:
+                entry = self.read_entry(album_url, encoding)
+            if entry is not None:
+                return entry
+        return {"album_url": album_url, "encoding": encoding}
+
+    # Only given fields are written. They are merged into entry as it is stored in database at
+    # the moment, so that fields written by other instances of program aren't lost.
+    # Entries are modified only under lock, because other workers may be writing them at the
+    # same time.
+    def write(self, cache_entry, **fields):
+        with self.lock:
+            if self.ignore_cache:
+                cache_entry.update(fields)
+                return
+            album_url = cache_entry["album_url"]
+            encoding = cache_entry.get("encoding")
+            with self.transaction():
+                stored_entry = self.read_entry(album_url, encoding) or {
+                    "album_url": album_url,
+                    "encoding": encoding,
+                }
+                stored_entry.update(fields)
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO albums VALUES (?, ?, ?)",
+                    (album_url, encoding or "", json.dumps(stored_entry)),
+                )
+            cache_entry.clear()
+            cache_entry.update(stored_entry)
+
+    def add_file(self, file_name, album_url, encoding=None, file_hash=None):
+        if self.ignore_cache:
+            return
+        file_name = os.path.abspath(file_name)
+        stat = os.stat(file_name)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    file_name,
+                    os.path.dirname(file_name),
+                    stat.st_size,
+                    stat.st_mtime,
+                    file_hash,
+                    album_url,
+                    encoding or "",
+                ),
+            )
+
+    # Returns file of album in library, if it is still there
+    def find_file(self, album_url, encoding=None):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path FROM files WHERE album_url = ? AND encoding = ?",
+                (album_url, encoding or ""),
+            ).fetchall()
+        for (path,) in rows:
+            if os.path.exists(path):
+                return path
+        return None
+
+    # Returns job and whether it was created. Unfinished job of the same album is returned
+    # instead of creating a new one.
+    def add_job(self, album_url, print_url):
+        with self.transaction():
+            for job in self.get_jobs(unfinished=True):
+                if job["album_url"] == album_url and job["print_url"] == print_url:
+                    return job, False
+            now = time.time()
+            job = {
+                "album_url": album_url,
+                "print_url": print_url,
+                "status": "queued",
+                "created_at": now,
+                "updated_at": now,
+            }
+            cursor = self.connection.execute(
+                "INSERT INTO jobs (status, job) VALUES (?, ?)", ("queued", json.dumps(job))
+            )
+            job["id"] = cursor.lastrowid
+        return job, True
+
+    def update_job(self, job_id, **fields):
+        with self.transaction():
+            job = self.get_job(job_id)
+            job.update(fields, updated_at=time.time())
+            del job["id"]
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, job = ? WHERE id = ?",
+                (job["status"], json.dumps(job), job_id),
+            )
+
+    def get_job(self, job_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id, job FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return {**json.loads(row[1]), "id": row[0]} if row is not None else None
+
+    # Unfinished jobs are the ones, which are queued or in progress
+    def get_jobs(self, status=None, unfinished=False):
+        query = "SELECT id, job FROM jobs"
+        parameters = ()
+        if unfinished:
+            query += " WHERE status != 'done'"
+        elif status is not None:
+            query += " WHERE status = ?"
+            parameters = (status,)
+        with self.lock:
+            rows = self.connection.execute(query + " ORDER BY id", parameters).fetchall()
+        return [{**json.loads(job), "id": job_id} for job_id, job in rows]
+
+
+# Library is indexed incrementally: only directories, modification time of which has changed
+# (files were added, removed or renamed in them), are listed again. Files downloaded by this
+# program are recorded with their album urls, and if such file was moved or renamed, it is
+# recognized in its new place by its size and name or hash. Files of albums, which are in cache,
+# but not in index (they were downloaded before library was indexed), are recognized the same way.
+# Every directory is indexed in its own transaction and files are hashed outside of them, so that
+# other instances of program aren't blocked for long. Directory is recorded only after its
+# subdirectories, so that it is listed again, if indexing was interrupted.
+def update_file_index(cache, directories):
+    connection = cache.connection
+    added_file_count = 0
+
+    def scan(directory, parent):
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            with cache.transaction():
+                forget_directory(directory)
+            return
+        row = connection.execute(
+            "SELECT mtime FROM directories WHERE path = ?", (directory,)
+        ).fetchone()
+        changed = row is None or row[0] != mtime
+        if changed:
+            with cache.transaction():
+                subdirectories = scan_entries(directory)
+        else:
+            subdirectories = [
+                path
+                for (path,) in connection.execute(
+                    "SELECT path FROM directories WHERE parent = ?", (directory,)
+                ).fetchall()
+            ]
+        for subdirectory in subdirectories:
+            scan(subdirectory, directory)
+        if changed:
+            connection.execute(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", (directory, parent, mtime)
+            )
+
+    # Returns subdirectories
+    def scan_entries(directory):
+        nonlocal added_file_count
+        indexed_files = {
+            path: (size, mtime)
+            for path, size, mtime in connection.execute(
+                "SELECT path, size, mtime FROM files WHERE directory = ?", (directory,)
+            )
+        }
+        subdirectories = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                        continue
+                    if not entry.is_file() or entry.name.endswith(PART_FILE_SUFFIX):
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.path not in indexed_files:
+                    # File of album may be back where it was missing from
+                    connection.execute(
+                        "INSERT INTO files VALUES (?, ?, ?, ?, NULL, NULL, '') ON CONFLICT (path)"
+                        " DO UPDATE SET directory = excluded.directory, size = excluded.size,"
+                        " mtime = excluded.mtime",
+                        (entry.path, directory, stat.st_size, stat.st_mtime),
+                    )
+                    added_file_count += 1
+                elif indexed_files.pop(entry.path) != (stat.st_size, stat.st_mtime):
+                    connection.execute(
+                        "UPDATE files SET size = ?, mtime = ?, hash = NULL WHERE path = ?",
+                        (stat.st_size, stat.st_mtime, entry.path),
+                    )
+        for path in indexed_files:
+            forget_file(path)
+        for (path,) in connection.execute(
+            "SELECT path FROM directories WHERE parent = ?", (directory,)
+        ).fetchall():
+            if path not in subdirectories:
+                forget_directory(path)
+        return subdirectories
+
+    # Files of albums, which are not where they were, are kept with empty directory, until they
+    # are looked for in the rest of library
+    def forget_file(path):
+        connection.execute("DELETE FROM files WHERE path = ? AND album_url IS NULL", (path,))
+        connection.execute("UPDATE files SET directory = '' WHERE path = ?", (path,))
+
+    def forget_directory(directory):
+        for (path,) in connection.execute(
+            "SELECT path FROM files WHERE directory = ?", (directory,)
+        ).fetchall():
+            forget_file(path)
+        for (path,) in connection.execute(
+            "SELECT path FROM directories WHERE parent = ?", (directory,)
+        ).fetchall():
+            forget_directory(path)
+        connection.execute("DELETE FROM directories WHERE path = ?", (directory,))
+
+    # Returns files of albums in cache, which are not where they were
+    def add_albums_from_cache():
+        missing_files = []
+        for album_url, encoding, entry in connection.execute(
+            "SELECT album_url, encoding, entry FROM albums"
+        ).fetchall():
+            try:
+                entry = json.loads(entry)
+                local_file_name = entry.get("local_file_name")
+            except (ValueError, AttributeError):
+                continue
+            if not local_file_name:
+                continue
+            if os.path.exists(local_file_name):
+                connection.execute(
+                    "UPDATE files SET album_url = ?, encoding = ?, hash = ?"
+                    " WHERE path = ? AND album_url IS NULL",
+                    (album_url, encoding, entry.get("file_hash"), os.path.abspath(local_file_name)),
+                )
+            elif entry.get("file_size") is not None:
+                missing_files.append(
+                    (
+                        local_file_name,
+                        entry["file_size"],
+                        entry.get("file_hash"),
+                        album_url,
+                        encoding,
+                    )
+                )
+        return missing_files
+
+    # Returns pairs of missing files and their new paths. Files, which were moved, are matched
+    # first, and then renamed ones. Only files, album of which isn't known, are candidates.
+    def find_moved_files(missing_files):
+        sizes = {missing_file[1] for missing_file in missing_files}
+        candidates_by_size = {}
+        for path, size in connection.execute(
+            "SELECT path, size FROM files WHERE album_url IS NULL AND directory != ''"
+        ):
+            if size in sizes:
+                candidates_by_size.setdefault(size, []).append(path)
+        moved_files = []
+        missing_files = list(missing_files)
+        for renamed in (False, True):
+            for missing_file in list(missing_files):
+                old_path, size, file_hash, album_url, encoding = missing_file
+                candidates = candidates_by_size.get(size, [])
+                if not renamed:
+                    new_path = next(
+                        (
+                            path
+                            for path in candidates
+                            if os.path.basename(path) == os.path.basename(old_path)
+                        ),
+                        None,
+                    )
+                elif file_hash:
+                    algorithm, _, digest = file_hash.partition(":")
+                    new_path = next(
+                        (
+                            path
+                            for path in candidates
+                            if hash_file(path, hashlib.new(algorithm)).hexdigest() == digest
+                        ),
+                        None,
+                    )
+                else:
+                    new_path = candidates[0] if len(candidates) == 1 else None
+                if new_path is None:
+                    continue
+                candidates.remove(new_path)
+                missing_files.remove(missing_file)
+                moved_files.append((missing_file, new_path))
+        return moved_files
+
+    new_directories = [
+        directory
+        for directory in directories
+        if connection.execute("SELECT 1 FROM directories WHERE path = ?", (directory,)).fetchone()
+        is None
+    ]
+    for directory in directories:
+        scan(directory, None)
+    # Files of albums outside of indexed directories (e.g. in download directory) aren't listed by
+    # scan, so every one of them is checked, whether it is still there
+    outside_files = [
+        (path,)
+        for (path,) in connection.execute(
+            "SELECT path FROM files WHERE album_url IS NOT NULL AND directory != ''"
+            " AND directory NOT IN (SELECT path FROM directories)"
+        ).fetchall()
+        if not os.path.exists(path)
+    ]
+    if outside_files:
+        with cache.transaction():
+            connection.executemany("UPDATE files SET directory = '' WHERE path = ?", outside_files)
+    missing_files = []
+    if new_directories:
+        with cache.transaction():
+            missing_files = add_albums_from_cache()
+    missing_files += connection.execute(
+        "SELECT path, size, hash, album_url, encoding FROM files WHERE directory = ''"
+    ).fetchall()
+    moved_files = find_moved_files(missing_files) if missing_files else []
+    with cache.transaction():
+        for (_, _, file_hash, album_url, encoding), new_path in moved_files:
+            connection.execute(
+                "UPDATE files SET album_url = ?, encoding = ?, hash = ?"
+                " WHERE path = ? AND album_url IS NULL",
+                (album_url, encoding, file_hash, new_path),
+            )
+        # Files, which weren't found, are forgotten
+        connection.executemany(
+            "DELETE FROM files WHERE path = ? AND directory = ''",
+            [(missing_file[0],) for missing_file in missing_files],
+        )
+        (file_count,) = connection.execute(
+            "SELECT COUNT(*) FROM files WHERE directory != ''"
+        ).fetchone()
+    eprint(
+        f"{file_count} files in library index: {added_file_count} new, {len(moved_files)}"
+        " moved or renamed files of downloaded albums."
+    )
+
+
+class AlbumDownloader:
+    def __init__(
+        self, args, cache, download_dir, session, wait_times, browser_pool, rate_controller
+    ):
+        self.args = args
+        self.cache = cache
+        self.download_dir = download_dir
+        self.session = session
+        self.wait_times = wait_times
+        self.browser_pool = browser_pool
+        self.rate_controller = rate_controller
+        self.driver = None
+        # Metrics of album being processed
+        self.metrics = None
+        # Whether email may be given to bandcamp for album being processed. Otherwise
+        # EmailRequested is raised.
+        self.email_allowed = False
+
+    # Browser is taken from pool on first use and returned to it after album is resolved
+    def get_driver(self):
+        if self.driver is None:
+            with self.metrics.stage("driver_start"):
+                self.driver = self.browser_pool.acquire()
+        return self.driver
+
+    def release_driver(self, broken=False):
+        if self.driver is not None:
+            self.browser_pool.release(self.driver, broken)
+            self.driver = None
+
+    # Returns DownloadJob, if album should be downloaded, or exit code otherwise. If print_url is
+    # True, download url is printed instead of downloading album.
+    def resolve(self, album_url, print_url=False, email_allowed=False):
+        album_url = remove_url_query_parameters(album_url)
+        self.metrics = AlbumMetrics(album_url)
+        self.email_allowed = email_allowed
+        try:
+            return self.handle_errors(album_url, self.resolve_download_url, album_url, print_url)
+        finally:
+            self.release_driver()
+
+    def download(self, download_job):
+        self.metrics = download_job.metrics
+        return self.handle_errors(download_job.album_url, self.download_album, download_job)
+
+    def handle_errors(self, album_url, function, *args):
+        try:
+            return function(*args)
+        except AbortAlbum as e:
+            return e.code
+        except WebDriverException as e:
+            eprint(f"Browser error while processing '{album_url}': {e.msg}")
+            # Browser may be in unusable state after an error, so it is replaced for next album
+            self.release_driver(broken=True)
+        except OSError as e:
+            if is_request_exception(e):
+                eprint(f"Network error while processing '{album_url}': {e}")
+            else:
+                eprint(f"Error while processing '{album_url}': {e}")
+        return ExitCodes.UNDOWNLOADABLE
+
+    # Returns list of DownloadJobs (one for every encoding to be downloaded) or exit code
+    def resolve_download_url(self, album_url, print_url):
+        args = self.args
+        metrics = self.metrics
+        onsite_encodings = get_onsite_encodings(args.encoding)
+
+        with metrics.stage("cache_lookup"):
+            cache_entries = {
+                encoding: self.cache.get_entry(album_url, encoding) for encoding in onsite_encodings
+            }
+        if any(not cache_entry.get("downloadable", True) for cache_entry in cache_entries.values()):
+            eprint("Album marked as undownloadable in cache. Aborting.")
+            return ExitCodes.UNDOWNLOADABLE
+
+        if not args.dont_skip_if_file_exists and not print_url:
+            for encoding, cache_entry in list(cache_entries.items()):
+                file_name = self.find_downloaded_file(cache_entry)
+                if file_name is None:
+                    continue
+                if not verify_local_file(file_name, cache_entry, args.verify_files):
+                    eprint(
+                        f"File in '{file_name}' differs from downloaded one.",
+                        "Rerun program with --dont-skip-if-file-exists to redownload it.",
+                    )
+                    return ExitCodes.FILE_CORRUPTED
+                eprint(
+                    f"File exists in '{file_name}'. Skipping scraping and downloading.",
+                    "Rerun program with --dont-skip-if-file-exists to redownload.",
+                )
+                del cache_entries[encoding]
+            if not cache_entries:
+                return ExitCodes.SUCCESS
+
+        download_urls = {}
+        if not args.dont_skip_scraping:
+            with metrics.stage("url_probe"):
+                for encoding, cache_entry in cache_entries.items():
+                    if cache_entry.get("download_url") is not None and self.is_download_url_active(
+                        cache_entry
+                    ):
+                        download_urls[encoding] = cache_entry["download_url"]
+
+        cover_url = None
+        # Download urls of all encodings, which aren't in cache, are resolved after a single
+        # checkout
+        unresolved_encodings = [encoding for encoding in cache_entries if encoding not in download_urls]
+        if unresolved_encodings:
+            resolved = None
+            if not args.browser_only:
+                with metrics.stage("http_resolve"):
+                    resolved = self.resolve_without_browser(
+                        album_url, cache_entries, unresolved_encodings
+                    )
+                metrics.resolved_by = "http"
+            if resolved is None:
+                with metrics.stage("browser_scrape"):
+                    resolved = self.scrape_in_healthy_browser(
+                        album_url, cache_entries, unresolved_encodings
+                    )
+                metrics.resolved_by = "browser"
+            resolved_download_urls, cover_url = resolved
+            # Download urls are saved right away, so that they are reused if download is
+            # interrupted
+            for encoding, download_url in resolved_download_urls.items():
+                self.cache.write(
+                    cache_entries[encoding],
+                    download_url=download_url,
+                    download_url_obtained_at=time.time(),
+                    download_url_expires_at=get_download_url_expiry(download_url),
+                )
+            download_urls.update(resolved_download_urls)
+        else:
+            metrics.resolved_by = "cache"
+            eprint("Active download url exists in cache. Skipping scraping.")
+
+        if print_url:
+            for encoding in cache_entries:
+                print(download_urls[encoding])
+            return ExitCodes.SUCCESS
+
+        return [
+            DownloadJob(
+                album_url,
+                cache_entry,
+                download_urls[encoding],
+                cover_url,
+                metrics,
+                encoding if len(onsite_encodings) > 1 else None,
+            )
+            for encoding, cache_entry in cache_entries.items()
+        ]
+
+    # File is looked for where it was downloaded to, in download directory and in library
+    def find_downloaded_file(self, cache_entry):
+        local_file_name = cache_entry.get("local_file_name")
+        if local_file_name is not None:
+            if os.path.exists(local_file_name):
+                return local_file_name
+            download_directory_file_name = os.path.join(
+                self.download_dir, os.path.split(local_file_name)[-1]
+            )
+            if os.path.exists(download_directory_file_name):
+                return download_directory_file_name
+        if self.args.library:
+            library_file_name = self.cache.find_file(
+                cache_entry["album_url"], cache_entry["encoding"]
+            )
+            if library_file_name is not None:
+                self.cache.write(cache_entry, local_file_name=library_file_name)
+                return library_file_name
+        return None
+
+    # Download urls are signed with expiry time, so url which is known to be valid for a while
+    # is used without checking it. Otherwise it is checked with a cheap HEAD request.
+    def is_download_url_active(self, cache_entry):
+        expires_at = cache_entry.get("download_url_expires_at") or get_download_url_expiry(
+            cache_entry["download_url"]
+        )
+        if expires_at is not None:
+            return expires_at - time.time() > DOWNLOAD_URL_EXPIRY_MARGIN
+        r = self.session.head(
+            cache_entry["download_url"], allow_redirects=True, timeout=self.args.wait_time
+        )
+        if r.status_code == 405:
+            with self.session.get(
+                cache_entry["download_url"], stream=True, timeout=self.args.wait_time
+            ) as r:
+                return r.status_code == 200
+        return r.status_code == 200
+
+    def download_album(self, download_job):
+        import requests
+
+        args = self.args
+        cache_entry = download_job.cache_entry
+        download_url = download_job.download_url
+        cover_url = download_job.cover_url
+        metrics = download_job.metrics
+
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                with metrics.stage("download"):
+                    local_file_name = self.download_file(
+                        download_url,
+                        cache_entry,
+                        "track" if cover_url else "album",
+                        download_job.file_name_tag,
+                    )
+                break
+            except (requests.RequestException, IncompleteDownload) as e:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+                metrics.add_retry()
+                eprint(f"Download interrupted ({e}). Resuming...")
+        if local_file_name is None:
+            return ExitCodes.SUCCESS
+
+        if cover_url:
+            cover_file_name = get_cover_file_name(local_file_name)
+            if check_cover_file(cover_file_name, args.dont_skip_if_file_exists):
+                with metrics.stage("cover_download"):
+                    with self.session.get(cover_url, stream=True) as r:
+                        with open(cover_file_name, "wb") as f:
+                            shutil.copyfileobj(r.raw, f)
+
+        # Add album url, download url and local file name to json file in cache in order to avoid
+        # scraping the page or downloading the album twice
+        self.cache.write(cache_entry, download_url=download_url, local_file_name=local_file_name)
+        self.cache.add_file(
+            local_file_name,
+            cache_entry["album_url"],
+            cache_entry["encoding"],
+            cache_entry.get("file_hash"),
+        )
+
+        return ExitCodes.SUCCESS
+
+    # File is downloaded to .part file, which is renamed only after the whole file is received.
+    # Offset of interrupted download is kept in cache, so that it is resumed with range request
+    # instead of being started over. Returns None if download was skipped.
+    def download_file(self, download_url, cache_entry, item_type, file_name_tag=None):
+        args = self.args
+        partial_download, offset = get_partial_download(cache_entry)
+        part_file_name = partial_download.get("file_name")
+        segments = partial_download.get("segments")
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        with self.session.get(download_url, stream=True, headers=headers) as r:
+            if r.status_code == 416 and get_content_range_total(r) == offset:
+                # Whole file was received, but wasn't renamed
+                local_file_name = part_file_name[: -len(PART_FILE_SUFFIX)]
+                fields = StreamProcessor(local_file_name, args.checksum, args.extract).finish()
+                os.replace(part_file_name, local_file_name)
+                self.cache.write(cache_entry, partial_download=None, **fields)
+                return local_file_name
+            r.raise_for_status()
+
+            local_file_name = get_local_file_name(
+                self.download_dir, r.headers["content-disposition"], file_name_tag
+            )
+            if not check_local_file(local_file_name, args.dont_skip_if_file_exists):
+                return None
+
+            if part_file_name == local_file_name + PART_FILE_SUFFIX and (
+                segments is not None or r.status_code == 206
+            ):
+                total_size = partial_download.get("total_size") or get_content_range_total(r)
+                eprint(f"Resuming download of {item_type} to '{local_file_name}'...")
+            else:
+                # Server ignored range or partial file belongs to another file
+                offset = 0
+                segments = None
+                total_size = r.headers.get("content-length")
+                total_size = int(total_size) if total_size is not None else None
+                eprint(f"Downloading {item_type} to '{local_file_name}'...")
+                if (
+                    args.connections > 1
+                    and total_size is not None
+                    and total_size >= 2 * MIN_SEGMENT_SIZE
+                    and r.headers.get("accept-ranges") == "bytes"
+                ):
+                    segments = split_into_segments(total_size, args.connections)
+            part_file_name = local_file_name + PART_FILE_SUFFIX
+            processor = StreamProcessor(local_file_name, args.checksum, args.extract)
+
+            if segments is None:
+                processor.start(offset)
+                self.download_stream(r, part_file_name, offset, total_size, cache_entry, processor)
+
+        if segments is not None:
+            self.download_segments(download_url, part_file_name, segments, total_size, cache_entry)
+        fields = processor.finish()
+        os.replace(part_file_name, local_file_name)
+        self.cache.write(cache_entry, partial_download=None, **fields)
+        return local_file_name
+
+    def download_stream(self, r, part_file_name, offset, total_size, cache_entry, processor):
+        downloaded_bytes = offset
+        self.cache.write(
+            cache_entry,
+            partial_download={"file_name": part_file_name, "downloaded_bytes": downloaded_bytes},
+        )
+        try:
+            with open(part_file_name, "ab" if offset else "wb") as f:
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    processor.update(chunk)
+                    downloaded_bytes += len(chunk)
+                    self.metrics.add_bytes(len(chunk))
+        finally:
+            self.cache.write(
+                cache_entry,
+                partial_download={"file_name": part_file_name, "downloaded_bytes": downloaded_bytes},
+            )
+        if total_size is not None and downloaded_bytes != total_size:
+            raise IncompleteDownload(f"received {downloaded_bytes} of {total_size} bytes")
+
+    # Large files are split into byte ranges, which are downloaded over parallel connections
+    # straight to their offsets in preallocated file. Progress of every segment is kept in cache
+    # and saved while segments are downloaded, so that it isn't lost, if program is killed.
+    def download_segments(self, download_url, part_file_name, segments, total_size, cache_entry):
+        if not os.path.exists(part_file_name) or os.path.getsize(part_file_name) != total_size:
+            with open(part_file_name, "wb") as f:
+                f.truncate(total_size)
+
+        # Segments are copied under cache lock, so that progress is saved in the order it is made
+        def save_progress():
+            with self.cache.lock:
+                self.cache.write(
+                    cache_entry,
+                    partial_download={
+                        "file_name": part_file_name,
+                        "total_size": total_size,
+                        "segments": [list(segment) for segment in segments],
+                    },
+                )
+
+        save_progress()
+        eprint(f"Downloading in {len(segments)} segments...")
+        try:
+            with ThreadPoolExecutor(max_workers=self.args.connections) as executor:
+                for future in [
+                    executor.submit(
+                        self.download_segment, download_url, part_file_name, segment, save_progress
+                    )
+                    for segment in segments
+                ]:
+                    future.result()
+        finally:
+            save_progress()
+
+        downloaded_bytes = sum(downloaded for _, _, downloaded in segments)
+        if downloaded_bytes != total_size or os.path.getsize(part_file_name) != total_size:
+            raise IncompleteDownload(f"received {downloaded_bytes} of {total_size} bytes")
+
+    # Segment is a mutable [first byte, last byte, downloaded bytes] list. Chunks are flushed
+    # before they are counted, so that saved progress never includes bytes not written to file.
+    def download_segment(self, download_url, part_file_name, segment, save_progress):
+        start, end, _ = segment
+        if start + segment[2] > end:
+            return
+        headers = {"Range": f"bytes={start + segment[2]}-{end}"}
+        with self.session.get(download_url, stream=True, headers=headers) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise IncompleteDownload("server ignored range request")
+            with open(part_file_name, "r+b") as f:
+                f.seek(start + segment[2])
+                unsaved_bytes = 0
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    chunk = chunk[: end + 1 - start - segment[2]]
+                    f.write(chunk)
+                    f.flush()
+                    segment[2] += len(chunk)
+                    self.metrics.add_bytes(len(chunk))
+                    unsaved_bytes += len(chunk)
+                    if unsaved_bytes >= SEGMENT_PROGRESS_SIZE:
+                        save_progress()
+                        unsaved_bytes = 0
+        if start + segment[2] != end + 1:
+            raise IncompleteDownload(f"segment {start}-{end} is incomplete")
+
+    def mark_undownloadable(self, cache_entries):
+        for cache_entry in cache_entries.values():
+            self.cache.write(cache_entry, downloadable=False)
+        raise AbortAlbum(ExitCodes.UNDOWNLOADABLE)
+
+    # Tries to resolve download urls with plain http requests, which is much faster than
+    # clicking through album page in browser. Returns dict of download urls of encodings and
+    # cover url or None, if it is not possible.
+    def resolve_without_browser(self, album_url, cache_entries, onsite_encodings):
+        import requests
+
+        args = self.args
+        cover_url = None
+
+        try:
+            eprint(f"Fetching '{album_url}'...")
+            r = self.session.get(album_url, timeout=args.wait_time)
+            r.raise_for_status()
+            tralbum_data = parse_data_attribute(r.text, "data-tralbum")
+            if tralbum_data is None:
+                return None
+
+            minimum_price = (tralbum_data.get("current") or {}).get("minimum_price")
+            if (
+                not args.skip_nyp_check
+                and isinstance(minimum_price, (int, float))
+                and minimum_price > 0
+            ):
+                eprint("Album is not name your price. Aborting.")
+                self.mark_undownloadable(cache_entries)
+
+            # Only albums with direct free download can be downloaded without browser, name your
+            # price checkout requires clicking through the dialog
+            free_download_page = tralbum_data.get("freeDownloadPage")
+            if not free_download_page:
+                return None
+
+            if tralbum_data.get("item_type") == "track":
+                cover_link = re.search(
+                    r'<div id="tralbumArt">\s*<a class="popupImage" href="([^"]+)"', r.text
+                )
+                if cover_link:
+                    cover_url = unescape(cover_link.group(1)).replace("_10", "_0")
+                else:
+                    eprint("Track cover image not found.")
+
+            r = self.session.get(free_download_page, timeout=args.wait_time)
+            r.raise_for_status()
+            download_page_data = parse_data_attribute(r.text, "data-blob")
+            if download_page_data is None:
+                return None
+            downloads = download_page_data["digital_items"][0]["downloads"]
+            download_urls = {}
+            for encoding in onsite_encodings:
+                onsite_encoding = encoding
+                if onsite_encoding is None:
+                    onsite_encoding = "mp3-320" if "mp3-320" in downloads else next(iter(downloads))
+                if onsite_encoding not in downloads:
+                    eprint(f"Encoding '{onsite_encoding}' not found on download page.")
+                    return None
+
+                download_url = wait_for_prepared_download(
+                    self.session,
+                    downloads[onsite_encoding]["url"],
+                    args.wait_time,
+                    args.preparing_wait_time,
+                )
+                if download_url is None:
+                    return None
+                download_urls[encoding] = download_url
+            return download_urls, cover_url
+        except (requests.RequestException, ValueError, LookupError, TypeError) as e:
+            eprint(f"Failed to resolve download url without browser: {e!r}.")
+            return None
+
+    # If browser crashed while scraping, it is replaced and album is scraped once again
+    def scrape_in_healthy_browser(self, album_url, cache_entries, onsite_encodings):
+        try:
+            return self.scrape(album_url, cache_entries, onsite_encodings)
+        except WebDriverException as e:
+            if self.driver is None or is_driver_alive(self.driver):
+                raise
+            eprint(f"Browser crashed ({e.msg}). Retrying in a new browser...")
+            self.release_driver(broken=True)
+            return self.scrape(album_url, cache_entries, onsite_encodings)
+
+    def scrape(self, album_url, cache_entries, onsite_encodings):
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import Select
+
+        args = self.args
+        cover_url = None
+
+        driver = self.get_driver()
+
+        check_if_album_is_name_your_price = not args.skip_nyp_check
+        page_load_wait_time = args.wait_time
+        preparing_wait_time = args.preparing_wait_time
+        email_address = args.email
+        country_abbrev = args.country_abbrev
+        postal_code = args.postal_code
+
+        eprint(f"Opening '{album_url}'...")
+        self.load_page(album_url)
+
+        # Check if album is free download
+        try:
+            direct_free_download_button = driver.find_element(
+                By.XPATH,
+                "//button[@class='download-link buy-link'][text()='Free Download']"
+            )
+            direct_free_download_button.click()
+        except NoSuchElementException:
+            # Check if album is name your price
+            try:
+                if (
+                    check_if_album_is_name_your_price
+                    and driver.find_element(
+                        By.XPATH,
+                        "//span[@class='buyItemExtra buyItemNyp secondaryText']"
+                    ).text
+                    != "name your price"
+                ):
+                    eprint("Album is not name your price. Aborting.")
+                    self.mark_undownloadable(cache_entries)
+            except NoSuchElementException:
+                eprint(
+                    "Element indicating if is album name your price not found. Aborting."
+                )
+                self.mark_undownloadable(cache_entries)
+
+            is_track = False
+            try:
+                driver.find_element(
+                    By.XPATH,
+                    "//*[@id='track_table']"
+                )
+            except NoSuchElementException:
+                is_track = True
+
+            if is_track:
+                try:
+                    cover_url = driver.find_element(
+                        By.XPATH,
+                        "//*[@id='tralbumArt']/a"
+                    ).get_attribute("href").replace("_10", "_0")
+                except NoSuchElementException:
+                    eprint("Track cover image not found.")
+
+            try:
+                buy_link = driver.find_element(
+                    By.XPATH,
+                    "//button[@class='download-link buy-link']"
+                )
+                buy_link.click()
+            except NoSuchElementException:
+                eprint("'Buy Digital Album' link not found. Aborting.")
+                self.mark_undownloadable(cache_entries)
+
+            price_input_filled = driver.find_element(
+                By.XPATH,
+                "//input[@class='display-price numeric']"
+            )
+            price_input_filled.clear()
+            price_input_filled.send_keys("0")
+
+            free_download_link = self.wait_for_element(
+                "free download link",
+                "//a[@class='download-panel-free-download-link']",
+                page_load_wait_time,
+            )
+            free_download_link.click()
+
+            # Handle bandcamp asking for email
+            try:
+                # Check if element is interactable first to exit try block immediately if it is not
+                # present
+                email_input = driver.find_element(
+                    By.XPATH,
+                    "//*[@id='fan_email_address']"
+                )
+                email_input.send_keys(str(email_address))
+
+                asked_for_email = True
+                if not self.email_allowed:
+                    raise EmailRequested()
+                if email_address is None or postal_code is None:
+                    eprint(
+                        "Bandcamp asked for email, but no email address or postal code specified."
+                        " Aborting."
+                    )
+                    raise AbortAlbum(ExitCodes.EMAIL_UNSPECIFIED)
+                if country_abbrev is not None:
+                    country_dropdown_list = Select(
+                        driver.find_element(By.XPATH, "//*[@id='fan_email_country']")
+                    )
+                    country_dropdown_list.select_by_value(country_abbrev.upper())
+                postal_code_input = driver.find_element(
+                    By.XPATH,
+                    "//*[@id='fan_email_postalcode']"
+                )
+                postal_code_input.send_keys(postal_code)
+            except ElementNotInteractableException:
+                asked_for_email = False
+
+            checkout_button = driver.find_element(
+                By.XPATH,
+                "//button[@class='download-panel-checkout-button']"
+            )
+            # Selenium thinks that checkout button is invisible and refuses to click it, so it is
+            # clicked with JavaScript
+            driver.execute_script("arguments[0].click();", checkout_button)
+
+            if asked_for_email:
+                eprint(
+                    f"An email with download link has been sent to {email_address}.",
+                    "Paste link here to continue: ",
+                )
+                try:
+                    link_from_email = input()
+                except EOFError:
+                    # Stdin may be already consumed by album urls
+                    eprint("Can't read link from stdin. Aborting.")
+                    raise AbortAlbum(ExitCodes.EMAIL_UNSPECIFIED)
+                self.load_page(link_from_email)
+            else:
+                self.wait_until(
+                    "checkout", lambda: driver.current_url != album_url, page_load_wait_time
+                )
+
+        # Choose encodings from dropdown list one after another
+        download_urls = {}
+        for onsite_encoding in onsite_encodings:
+            if onsite_encoding is not None:
+                encoding_dropdown_button = self.wait_for_element(
+                    "encoding dropdown list", "//*[@id='format-type']", page_load_wait_time
+                )
+                encoding_dropdown_button.click()
+
+                format_list_element = driver.find_element(
+                    By.XPATH,
+                    f"//*[@id='format-type']/option[@value='{onsite_encoding}']"
+
+                )
+                format_list_element.click()
+
+            download_urls[onsite_encoding] = self.wait_for_download_link(
+                set(download_urls.values()), preparing_wait_time
+            )
+
+        return download_urls, cover_url
+
+    # Link to previously chosen encoding may stay on page, until link to newly chosen one is
+    # prepared, so link is awaited to change
+    def wait_for_download_link(self, previous_download_urls, timeout):
+        from selenium.webdriver.common.by import By
+
+        xpath = "//*[@id='post-checkout-info']/div[1]/div[2]/div[4]/a[1]"
+        if not previous_download_urls:
+            return self.wait_for_element("preparing download", xpath, timeout).get_attribute("href")
+
+        def get_new_download_url():
+            direct_download_link = self.driver.find_element(By.XPATH, xpath)
+            download_url = direct_download_link.get_attribute("href")
+            if direct_download_link.is_displayed() and download_url not in previous_download_urls:
+                return download_url
+            return None
+
+        return self.wait_until("preparing download", get_new_download_url, timeout)
+
+    # Page loads are paced by rate controller like http requests. If challenge page is shown
+    # instead of requested one, page is loaded once again, after host is given time to recover.
+    def load_page(self, url):
+        from selenium.webdriver.common.by import By
+
+        driver = self.driver
+        for attempt in range(self.args.http_retries + 1):
+            time.sleep(self.rate_controller.reserve(url))
+            with self.metrics.stage("page_load"):
+                driver.get(url)
+            throttled = (
+                CHALLENGE_PAGE_TITLE_PATTERN.match(f"<title>{driver.title}") is not None
+                and not driver.find_elements(By.XPATH, "//*[@data-tralbum or @id='pagedata']")
+            )
+            self.rate_controller.report(url, throttled)
+            if not throttled:
+                return
+        eprint("Bandcamp keeps showing challenge page instead of requested one.")
+
+    # Element is awaited with a MutationObserver in browser, which reports it as soon as it
+    # becomes visible instead of polling for it. If browser can't run asynchronous scripts,
+    # element is polled for.
+    def wait_for_element(self, name, xpath, timeout):
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
+
+        driver = self.driver
+        start_time = time.monotonic()
+        try:
+            driver.set_script_timeout(timeout)
+            element = driver.execute_async_script(WAIT_FOR_ELEMENT_SCRIPT, xpath)
+            if element is None or not element.is_displayed():
+                raise JavascriptException("element is not displayed")
+            return element
+        except TimeoutException:
+            raise
+        except WebDriverException:
+            remaining_time = timeout - (time.monotonic() - start_time)
+            return poll_until(
+                lambda: EC.visibility_of_element_located((By.XPATH, xpath))(driver),
+                remaining_time,
+                self.args.poll_interval,
+            )
+        finally:
+            # Waits that time out are recorded too, because they are needed to tune wait times
+            self.record_wait(name, time.monotonic() - start_time)
+
+    def wait_until(self, name, condition, timeout):
+        start_time = time.monotonic()
+        try:
+            return poll_until(condition, timeout, self.args.poll_interval)
+        finally:
+            self.record_wait(name, time.monotonic() - start_time)
+
+    def record_wait(self, name, duration):
+        self.wait_times.record(name, duration)
+        self.metrics.add_stage_time(name.replace(" ", "_"), duration)
+
+
+# Downloads files with aiohttp, so that hundreds of transfers can be in flight at the same time
+# without a thread for each one
+class AsyncDownloader:
+    def __init__(self, args, cache, download_dir, rate_controller):
+        self.args = args
+        self.cache = cache
+        self.download_dir = download_dir
+        self.rate_controller = rate_controller
+        self.session = None
+        self.bandwidth_limiter = None
+
+    async def run(self, download_queue, set_result):
+        import asyncio
+
+        import aiohttp
+
+        args = self.args
+        loop = asyncio.get_running_loop()
+        connector = aiohttp.TCPConnector(
+            limit=args.download_jobs, limit_per_host=args.connections_per_host
+        )
+        timeout = aiohttp.ClientTimeout(sock_connect=args.http_timeout, sock_read=args.http_timeout)
+        if args.bandwidth_limit:
+            self.bandwidth_limiter = BandwidthLimiter(args.bandwidth_limit)
+        # Number of transfers in flight is limited, so that download jobs don't pile up
+        semaphore = asyncio.Semaphore(args.download_jobs)
+
+        async def download(i, download_job):
+            try:
+                code = await self.download(download_job)
+            except Exception:
+                print_unexpected_error(download_job.album_url)
+                code = ExitCodes.UNDOWNLOADABLE
+            finally:
+                semaphore.release()
+            set_result(i, code, download_job.metrics)
+
+        tasks = set()
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as self.session:
+            while True:
+                await semaphore.acquire()
+                item = await loop.run_in_executor(None, download_queue.get)
+                if item is None:
+                    break
+                task = asyncio.create_task(download(*item))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+
+    async def download(self, download_job):
+        import asyncio
+
+        import aiohttp
+
+        try:
+            return await self.download_album(download_job)
+        except AbortAlbum as e:
+            return e.code
+        except (aiohttp.ClientError, asyncio.TimeoutError, IncompleteDownload) as e:
+            eprint(f"Network error while processing '{download_job.album_url}': {e!r}")
+        except OSError as e:
+            eprint(f"Error while processing '{download_job.album_url}': {e}")
+        return ExitCodes.UNDOWNLOADABLE
+
+    async def download_album(self, download_job):
+        import asyncio
+
+        import aiohttp
+
+        args = self.args
+        cache_entry = download_job.cache_entry
+        download_url = download_job.download_url
+        cover_url = download_job.cover_url
+        metrics = download_job.metrics
+
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                with metrics.stage("download"):
+                    local_file_name = await self.download_file(
+                        download_url,
+                        cache_entry,
+                        "track" if cover_url else "album",
+                        metrics,
+                        download_job.file_name_tag,
+                    )
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError, IncompleteDownload) as e:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+                metrics.add_retry()
+                eprint(f"Download interrupted ({e!r}). Resuming...")
+        if local_file_name is None:
+            return ExitCodes.SUCCESS
+
+        if cover_url:
+            cover_file_name = get_cover_file_name(local_file_name)
+            if check_cover_file(cover_file_name, args.dont_skip_if_file_exists):
+                with metrics.stage("cover_download"):
+                    async with await self.get(cover_url) as r:
+                        r.raise_for_status()
+                        with open(cover_file_name, "wb") as f:
+                            await self.copy_content(r, f)
+
+        await asyncio.to_thread(
+            self.cache.write,
+            cache_entry,
+            download_url=download_url,
+            local_file_name=local_file_name,
+        )
+        await asyncio.to_thread(
+            self.cache.add_file,
+            local_file_name,
+            cache_entry["album_url"],
+            cache_entry["encoding"],
+            cache_entry.get("file_hash"),
+        )
+
+        return ExitCodes.SUCCESS
+
+    # Same as AlbumDownloader.download_file, but segmented downloads are not used, because
+    # transfers of different files already run in parallel. Segmented partial downloads are
+    # started over. Hashing and extracting part file and writing to cache may take a while, so
+    # they are done in threads, not to block other transfers.
+    async def download_file(
+        self, download_url, cache_entry, item_type, metrics, file_name_tag=None
+    ):
+        import asyncio
+
+        args = self.args
+        partial_download, offset = get_partial_download(cache_entry)
+        part_file_name = partial_download.get("file_name")
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        async with await self.get(download_url, headers=headers) as r:
+            if r.status == 416 and get_content_range_total(r) == offset:
+                local_file_name = part_file_name[: -len(PART_FILE_SUFFIX)]
+                processor = StreamProcessor(local_file_name, args.checksum, args.extract)
+                fields = await asyncio.to_thread(processor.finish)
+                os.replace(part_file_name, local_file_name)
+                await asyncio.to_thread(
+                    self.cache.write, cache_entry, partial_download=None, **fields
+                )
+                return local_file_name
+            r.raise_for_status()
+
+            local_file_name = get_local_file_name(
+                self.download_dir, r.headers["content-disposition"], file_name_tag
+            )
+            if not check_local_file(local_file_name, args.dont_skip_if_file_exists):
+                return None
+
+            if offset and r.status == 206 and part_file_name == local_file_name + PART_FILE_SUFFIX:
+                total_size = get_content_range_total(r)
+                eprint(f"Resuming download of {item_type} to '{local_file_name}'...")
+            else:
+                offset = 0
+                total_size = r.content_length
+                eprint(f"Downloading {item_type} to '{local_file_name}'...")
+            part_file_name = local_file_name + PART_FILE_SUFFIX
+            processor = StreamProcessor(local_file_name, args.checksum, args.extract)
+            await asyncio.to_thread(processor.start, offset)
+
+            downloaded_bytes = offset
+            await asyncio.to_thread(
+                self.cache.write,
+                cache_entry,
+                partial_download={"file_name": part_file_name, "downloaded_bytes": downloaded_bytes},
+            )
+            with open(part_file_name, "ab" if offset else "wb") as f:
+                try:
+                    downloaded_bytes += await self.copy_content(r, f, metrics, processor)
+                finally:
+                    await asyncio.to_thread(
+                        self.cache.write,
+                        cache_entry,
+                        partial_download={"file_name": part_file_name, "downloaded_bytes": f.tell()},
+                    )
+
+        if total_size is not None and downloaded_bytes != total_size:
+            raise IncompleteDownload(f"received {downloaded_bytes} of {total_size} bytes")
+        fields = await asyncio.to_thread(processor.finish)
+        os.replace(part_file_name, local_file_name)
+        await asyncio.to_thread(self.cache.write, cache_entry, partial_download=None, **fields)
+        return local_file_name
+
+    # Requests are paced and throttled ones are retried the same way, as in session of threaded
+    # downloaders
+    async def get(self, url, headers=None):
+        import asyncio
+
+        retries = self.args.http_retries
+        for attempt in range(retries + 1):
+            await asyncio.sleep(self.rate_controller.reserve(url))
+            r = await self.session.get(url, headers=headers)
+            throttled = r.status in THROTTLING_STATUS_CODES
+            self.rate_controller.report(url, throttled, get_retry_after(r.headers))
+            if not throttled or attempt == retries:
+                return r
+            r.release()
+
+    async def copy_content(self, r, f, metrics=None, processor=None):
+        copied_bytes = 0
+        async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            if self.bandwidth_limiter is not None:
+                await self.bandwidth_limiter.consume(len(chunk))
+            f.write(chunk)
+            if processor is not None:
+                processor.update(chunk)
+            copied_bytes += len(chunk)
+            if metrics is not None:
+                metrics.add_bytes(len(chunk))
+        return copied_bytes
+
+
+# Hash of downloaded file is computed and zip archive is extracted while file is being downloaded,
+# so that file isn't read from disk once again. If download isn't streamed from its beginning
+# (it is resumed or downloaded in segments), what can't be done on the fly is done with part file
+# after download. Size, hash and directory archive is extracted to are returned as cache fields.
+class StreamProcessor:
+    def __init__(self, local_file_name, checksum, extract):
+        self.local_file_name = local_file_name
+        self.part_file_name = local_file_name + PART_FILE_SUFFIX
+        self.checksum = checksum
+        self.hash = hashlib.new(checksum) if checksum else None
+        if extract and local_file_name.lower().endswith(".zip"):
+            self.extract_dir = os.path.splitext(local_file_name)[0]
+        else:
+            self.extract_dir = None
+        self.extractor = None
+        self.streamed = False
+
+    # Must be called before first chunk of streamed download, which starts from offset
+    def start(self, offset):
+        self.streamed = True
+        if self.hash is not None and offset:
+            hash_file(self.part_file_name, self.hash)
+        if self.extract_dir is not None and not offset:
+            self.extractor = ZipStreamExtractor(self.extract_dir)
+
+    def update(self, chunk):
+        if self.hash is not None:
+            self.hash.update(chunk)
+        if self.extractor is not None:
+            self.extractor.feed(chunk)
+
+    def finish(self):
+        file_name = self.part_file_name
+        if not os.path.exists(file_name):
+            file_name = self.local_file_name
+        fields = {"file_size": os.path.getsize(file_name)}
+        if self.hash is not None:
+            if not self.streamed:
+                hash_file(file_name, self.hash)
+            fields["file_hash"] = f"{self.checksum}:{self.hash.hexdigest()}"
+        if self.extract_dir is not None:
+            if self.extractor is None or not self.extractor.close():
+                eprint(f"Extracting '{self.local_file_name}'...")
+                extract_zip_file(file_name, self.extract_dir)
+            fields["extract_dir"] = self.extract_dir
+        return fields
+
+
+# Extracts zip archive from stream of its bytes, checking crc of every entry. Only archives that
+# can be read without seeking are supported: entries must be stored with sizes in local headers
+# or deflated. On anything else extraction is abandoned, and archive is extracted after download.
+class ZipStreamExtractor:
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.buffer = bytearray()
+        self.entry = None
+        self.done = False
+        self.failed = False
+
+    def feed(self, data):
+        if self.done or self.failed:
+            return
+        data = memoryview(data)
+        try:
+            # Most of archive is usually stored tracks, which are written right from chunks instead
+            # of being buffered
+            while data and not self.buffer and self.is_reading_stored_data():
+                size = min(self.entry["remaining"], len(data))
+                self.write_stored_data(data[:size])
+                data = data[size:]
+            self.buffer += data
+            while self.process_buffer():
+                pass
+        except (OSError, ValueError, zlib.error) as e:
+            self.fail(e)
+
+    def is_reading_stored_data(self):
+        return self.entry is not None and self.entry["decompressor"] is None
+
+    def write_stored_data(self, data):
+        self.entry["remaining"] -= len(data)
+        self.write(data)
+        if self.entry["remaining"] == 0:
+            self.finish_entry()
+
+    # Returns True, if something was consumed from buffer
+    def process_buffer(self):
+        if self.entry is None:
+            return self.read_local_header()
+        entry = self.entry
+        if entry["data_descriptor_pending"]:
+            return self.read_data_descriptor()
+        if not self.buffer:
+            return False
+        if entry["decompressor"] is None:
+            data = bytes(self.buffer[: entry["remaining"]])
+            del self.buffer[: len(data)]
+            self.write_stored_data(data)
+            return True
+        decompressor = entry["decompressor"]
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        self.write(decompressor.decompress(data))
+        if decompressor.eof:
+            self.buffer[:0] = decompressor.unused_data
+            if entry["has_data_descriptor"]:
+                entry["data_descriptor_pending"] = True
+            else:
+                self.finish_entry()
+        return True
+
+    def read_local_header(self):
+        if len(self.buffer) < 4:
+            return False
+        signature = bytes(self.buffer[:4])
+        # Central directory follows the last entry
+        if signature in (b"PK\x01\x02", b"PK\x05\x06"):
+            self.done = True
+            return False
+        if signature != b"PK\x03\x04":
+            raise ValueError("local file header not found")
+        if len(self.buffer) < 30:
+            return False
+        (
+            flags,
+            method,
+            crc,
+            compressed_size,
+            size,
+            name_length,
+            extra_length,
+        ) = struct.unpack("<6xHH4xIIIHH", self.buffer[:30])
+        header_length = 30 + name_length + extra_length
+        if len(self.buffer) < header_length:
+            return False
+        name_bytes = bytes(self.buffer[30 : 30 + name_length])
+        name = name_bytes.decode("utf-8" if flags & 0x800 else "cp437")
+        extra = bytes(self.buffer[30 + name_length : header_length])
+        del self.buffer[:header_length]
+
+        zip64 = False
+        while len(extra) >= 4:
+            tag, length = struct.unpack("<HH", extra[:4])
+            if tag == 1:
+                zip64 = True
+                values = iter(struct.unpack(f"<{length // 8}Q", extra[4 : 4 + length // 8 * 8]))
+                if size == 0xFFFFFFFF:
+                    size = next(values)
+                if compressed_size == 0xFFFFFFFF:
+                    compressed_size = next(values)
+            extra = extra[4 + length :]
+        if flags & 0x1:
+            raise ValueError(f"'{name}' is encrypted")
+        has_data_descriptor = bool(flags & 0x8)
+        if method == 0 and has_data_descriptor:
+            raise ValueError(f"size of '{name}' is unknown")
+        if method not in (0, 8):
+            raise ValueError(f"'{name}' is compressed with unsupported method {method}")
+
+        path = os.path.normpath(os.path.join(self.directory, name))
+        if os.path.isabs(name) or not path.startswith(self.directory + os.sep):
+            raise ValueError(f"unsafe path '{name}'")
+        if name.endswith("/"):
+            os.makedirs(path, exist_ok=True)
+            file = None
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file = open(path, "wb")
+        self.entry = {
+            "name": name,
+            "file": file,
+            "crc": crc,
+            "actual_crc": 0,
+            "remaining": compressed_size,
+            "decompressor": zlib.decompressobj(-zlib.MAX_WBITS) if method == 8 else None,
+            "zip64": zip64,
+            "has_data_descriptor": has_data_descriptor,
+            "data_descriptor_pending": False,
+        }
+        if method == 0 and compressed_size == 0:
+            self.finish_entry()
+        return True
+
+    # Data descriptor follows deflated data, if sizes and crc weren't known, when local header
+    # was written. It may start with a signature.
+    def read_data_descriptor(self):
+        entry = self.entry
+        if len(self.buffer) < 4:
+            return False
+        offset = 4 if bytes(self.buffer[:4]) == b"PK\x07\x08" else 0
+        length = offset + (20 if entry["zip64"] else 12)
+        if len(self.buffer) < length:
+            return False
+        (entry["crc"],) = struct.unpack("<I", self.buffer[offset : offset + 4])
+        del self.buffer[:length]
+        entry["data_descriptor_pending"] = False
+        self.finish_entry()
+        return True
+
+    def write(self, data):
+        entry = self.entry
+        entry["actual_crc"] = zlib.crc32(data, entry["actual_crc"])
+        if entry["file"] is not None:
+            entry["file"].write(data)
+
+    def finish_entry(self):
+        entry = self.entry
+        self.entry = None
+        if entry["file"] is not None:
+            entry["file"].close()
+        if entry["actual_crc"] != entry["crc"]:
+            raise ValueError(f"crc of '{entry['name']}' doesn't match")
+
+    def fail(self, e):
+        self.failed = True
+        if self.entry is not None and self.entry["file"] is not None:
+            self.entry["file"].close()
+        self.entry = None
+        self.buffer = bytearray()
+        eprint(
+            f"Can't extract archive while downloading it ({e}).",
+            "It will be extracted after download.",
+        )
+
+    # Returns True, if the whole archive was extracted
+    def close(self):
+        if self.entry is not None and self.entry["file"] is not None:
+            self.entry["file"].close()
+        return self.done and not self.failed
+
+
+def hash_file(file_name, file_hash):
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash
+
+
+def extract_zip_file(file_name, directory):
+    import zipfile
+
+    try:
+        with zipfile.ZipFile(file_name) as archive:
+            archive.extractall(directory)
+    except zipfile.BadZipFile as e:
+        eprint(f"Downloaded archive is corrupted: {e}")
+        # Part file is removed, so that archive is downloaded anew next time
+        os.remove(file_name)
+        raise AbortAlbum(ExitCodes.FILE_CORRUPTED)
+
+
+# Size of file is compared with size of downloaded one, and hash is only checked if asked to,
+# because it requires reading the whole file
+def verify_local_file(file_name, cache_entry, verify_hash):
+    file_size = cache_entry.get("file_size")
+    if file_size is not None and os.path.getsize(file_name) != file_size:
+        return False
+    file_hash = cache_entry.get("file_hash")
+    if verify_hash and file_hash:
+        eprint(f"Verifying '{file_name}'...")
+        algorithm, _, digest = file_hash.partition(":")
+        return hash_file(file_name, hashlib.new(algorithm)).hexdigest() == digest
+    return True
+
+
+# Requests to every host are spaced according to request rate of the host, which is shared by all
+# workers. Hosts are sent requests at maximum rate (or without any limit), until they throttle
+# requests (respond with 429 or 5xx status or a challenge page). Then rate of host is halved and
+# nothing is sent to it for a while. Rate is raised back step by step with every healthy
+# response.
+class RateController:
+    def __init__(self, max_rate=None):
+        self.max_rate = max_rate
+        self.lock = threading.Lock()
+        # Rates of throttling hosts
+        self.rates = {}
+        # Time of next free request slot of every host
+        self.next_times = {}
+        # Throttled responses to requests sent before host was slowed down don't slow it down
+        # once again
+        self.slowed_down_until = {}
+        # Times of requests sent during last second to hosts, which aren't paced, so that their
+        # rate is known, when they start throttling
+        self.request_times = {}
+
+    # Reserves next request slot of host of url and returns time to wait for it
+    def reserve(self, url):
+        host = urlparse(url).hostname
+        with self.lock:
+            now = time.monotonic()
+            rate = self.rates.get(host, self.max_rate)
+            if rate is None:
+                request_times = self.request_times.setdefault(host, deque())
+                request_times.append(now)
+                while request_times[0] < now - 1:
+                    request_times.popleft()
+                return 0
+            start_time = max(now, self.next_times.get(host, now))
+            self.next_times[host] = start_time + 1 / rate
+        return start_time - now
+
+    def report(self, url, throttled, retry_after=None):
+        host = urlparse(url).hostname
+        with self.lock:
+            if not throttled:
+                if host in self.rates:
+                    rate = self.rates[host] + REQUEST_RATE_STEP
+                    if self.max_rate is not None and rate >= self.max_rate:
+                        del self.rates[host]
+                    else:
+                        self.rates[host] = rate
+                return
+            now = time.monotonic()
+            if now < self.slowed_down_until.get(host, 0):
+                return
+            rate = self.rates.get(host, self.max_rate)
+            if rate is None:
+                rate = len(self.request_times.pop(host, ()))
+            rate = self.rates[host] = max(rate / 2, MIN_REQUEST_RATE)
+            pause = retry_after if retry_after is not None else max(1 / rate, 1)
+            self.slowed_down_until[host] = now + pause
+            self.next_times[host] = max(self.next_times.get(host, now), now + pause)
+        eprint(f"'{host}' throttles requests. Slowing down to {rate:.2g} requests per second.")
+
+
+# Token bucket shared by all transfers of the event loop
+class BandwidthLimiter:
+    def __init__(self, bytes_per_second):
+        import asyncio
+
+        self.bytes_per_second = bytes_per_second
+        self.allowance = bytes_per_second
+        self.last_time = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def consume(self, amount):
+        import asyncio
+
+        async with self.lock:
+            now = time.monotonic()
+            self.allowance = min(
+                self.bytes_per_second,
+                self.allowance + (now - self.last_time) * self.bytes_per_second,
+            )
+            self.last_time = now
+            self.allowance -= amount
+            if self.allowance < 0:
+                await asyncio.sleep(-self.allowance / self.bytes_per_second)
+
+
+WAIT_FOR_ELEMENT_SCRIPT = """
+var xpath = arguments[0];
+var done = arguments[arguments.length - 1];
+function findVisibleElement() {
+    var element = document.evaluate(
+        xpath, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null
+    ).singleNodeValue;
+    if (
+        element
+        && element.getClientRects().length
+        && window.getComputedStyle(element).visibility !== "hidden"
+    ) {
+        return element;
+    }
+    return null;
+}
+var element = findVisibleElement();
+if (element) {
+    done(element);
+} else {
+    var observer = new MutationObserver(function () {
+        var element = findVisibleElement();
+        if (element) {
+            observer.disconnect();
+            done(element);
+        }
+    });
+    observer.observe(document, {childList: true, subtree: true, attributes: true});
+}
+"""
+
+
+# Polling interval starts small and grows up to max_poll_interval, so that fast conditions are
+# noticed quickly and slow ones don't make too many requests to browser
+def poll_until(condition, timeout, max_poll_interval):
+    deadline = time.monotonic() + timeout
+    poll_interval = MIN_POLL_INTERVAL
+    while True:
+        try:
+            value = condition()
+            if value:
+                return value
+        except (NoSuchElementException, StaleElementReferenceException):
+            pass
+        if time.monotonic() + poll_interval > deadline:
+            raise TimeoutException()
+        time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, max_poll_interval)
+
+
+# Durations of waits in browser are collected from all workers to help choosing --wait-time and
+# --preparing-wait-time
+class WaitTimes:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = {}
+
+    def record(self, name, duration):
+        with self.lock:
+            self.durations.setdefault(name, []).append(duration)
+
+    def print_summary(self):
+        with self.lock:
+            if not self.durations:
+                return
+            eprint("Wait times (in seconds):")
+            for name, durations in self.durations.items():
+                durations = sorted(durations)
+                eprint(
+                    f"{name}: count {len(durations)},",
+                    f"median {durations[len(durations) // 2]:.2f},",
+                    f"95th percentile {durations[int(len(durations) * 0.95)]:.2f},",
+                    f"max {durations[-1]:.2f}",
+                )
+
+
+# Timings of stages of processing a single album. Stages may be nested, e.g. page_load is a part of
+# browser_scrape, and waits in browser are stages named after them.
+class AlbumMetrics:
+    def __init__(self, album_url):
+        self.album_url = album_url
+        self.started_at = time.time()
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.downloaded_bytes = 0
+        self.retries = 0
+        self.resolved_by = None
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.monotonic() - start_time)
+
+    def add_stage_time(self, name, duration):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0) + duration
+
+    # Segments of a file are downloaded by several threads
+    def add_bytes(self, amount):
+        with self.lock:
+            self.downloaded_bytes += amount
+
+    def add_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def to_dict(self, code):
+        with self.lock:
+            download_time = self.stages.get("download")
+            return {
+                "album_url": self.album_url,
+                "started_at": self.started_at,
+                "outcome": code.name,
+                "exit_code": int(code),
+                "resolved_by": self.resolved_by,
+                "duration": time.monotonic() - self.start_time,
+                "stages": dict(self.stages),
+                "downloaded_bytes": self.downloaded_bytes,
+                "throughput": self.downloaded_bytes / download_time if download_time else None,
+                "retries": self.retries,
+            }
+
+
+# Json lines are appended as soon as album is done, so that metrics of many runs can be collected
+# in one file. Prometheus text file has totals of the whole run and is written when it ends.
+class MetricsWriter:
+    def __init__(self, metrics_file, metrics_format):
+        self.metrics_file = metrics_file
+        self.metrics_format = metrics_format
+        self.lock = threading.Lock()
+        self.file = None
+        self.albums = {}
+        self.stage_seconds = {}
+        self.downloaded_bytes = 0
+        self.retries = 0
+        if metrics_file is not None and metrics_format == "jsonl":
+            self.file = open(metrics_file, "a")
+
+    def write(self, metrics, code):
+        if self.metrics_file is None:
+            return
+        album_metrics = metrics.to_dict(code)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(json.dumps(album_metrics) + "\n")
+                self.file.flush()
+                return
+            self.albums[code.name] = self.albums.get(code.name, 0) + 1
+            for name, duration in album_metrics["stages"].items():
+                seconds_sum, count = self.stage_seconds.get(name, (0, 0))
+                self.stage_seconds[name] = (seconds_sum + duration, count + 1)
+            self.downloaded_bytes += album_metrics["downloaded_bytes"]
+            self.retries += album_metrics["retries"]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        elif self.metrics_file is not None:
+            self.write_prometheus()
+
+    # File is replaced atomically, so that collectors never read half-written file
+    def write_prometheus(self):
+        lines = ["# TYPE bandcamp_albums_total counter"]
+        for outcome, count in sorted(self.albums.items()):
+            lines.append(f'bandcamp_albums_total{{outcome="{outcome}"}} {count}')
+        lines.append("# TYPE bandcamp_stage_seconds summary")
+        for name, (seconds_sum, count) in sorted(self.stage_seconds.items()):
+            lines.append(f'bandcamp_stage_seconds_sum{{stage="{name}"}} {seconds_sum:.3f}')
+            lines.append(f'bandcamp_stage_seconds_count{{stage="{name}"}} {count}')
+        lines.append("# TYPE bandcamp_downloaded_bytes_total counter")
+        lines.append(f"bandcamp_downloaded_bytes_total {self.downloaded_bytes}")
+        lines.append("# TYPE bandcamp_download_retries_total counter")
+        lines.append(f"bandcamp_download_retries_total {self.retries}")
+        temporary_file_name = self.metrics_file + ".tmp"
+        with open(temporary_file_name, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temporary_file_name, self.metrics_file)
+
+
+# Browsers are shared by scrapers. They are launched in background, so that scrapers don't wait
+# for them, and are replaced after a number of albums or if they use too much memory, because
+# browsers leak memory in long runs. Browsers that crashed or stopped responding are replaced too.
+class BrowserPool:
+    def __init__(self, args, size, album_url_queue):
+        self.args = args
+        self.size = size
+        self.album_url_queue = album_url_queue
+        self.lock = threading.Lock()
+        # Launched browsers, which aren't used by scrapers, and errors of launching them
+        self.idle_drivers = queue.Queue()
+        # Number of albums processed by every browser
+        self.album_counts = {}
+        # Browsers being launched are counted too
+        self.browser_count = 0
+        # Number of consumers waiting for idle browser
+        self.waiting_count = 0
+        self.threads = []
+        self.closed = False
+
+    def prelaunch(self):
+        for _ in range(self.size):
+            self.launch_in_background()
+
+    def launch_in_background(self):
+        with self.lock:
+            if self.closed or self.browser_count >= self.size:
+                return
+            self.browser_count += 1
+            thread = threading.Thread(target=self.launch_into_pool)
+            self.threads.append(thread)
+        thread.start()
+
+    def launch_into_pool(self):
+        try:
+            self.idle_drivers.put(self.launch())
+        except (WebDriverException, OSError) as e:
+            self.idle_drivers.put(e)
+
+    # Must be called with browser already counted
+    def launch(self):
+        try:
+            driver = create_driver(
+                self.args.driver, self.args.show_browser_window, self.args.minimal_browser
+            )
+        except BaseException:
+            with self.lock:
+                self.browser_count -= 1
+            raise
+        with self.lock:
+            self.album_counts[driver] = 0
+        return driver
+
+    # Browsers that don't respond are replaced a limited number of times, so that a browser that
+    # can't be run at all fails the album instead of being relaunched forever
+    def acquire(self):
+        for _ in range(BROWSER_LAUNCH_ATTEMPTS):
+            with self.lock:
+                # Every scraper holds at most one browser, so if none is idle or being launched,
+                # there is room for one more
+                launch_now = self.idle_drivers.empty() and self.browser_count < self.size
+                if launch_now:
+                    self.browser_count += 1
+                else:
+                    self.waiting_count += 1
+            if launch_now:
+                driver = self.launch()
+            else:
+                try:
+                    driver = self.idle_drivers.get()
+                finally:
+                    with self.lock:
+                        self.waiting_count -= 1
+                if isinstance(driver, BaseException):
+                    raise driver
+            if is_driver_alive(driver):
+                return driver
+            eprint("Browser doesn't respond. Replacing it...")
+            self.retire(driver)
+        raise WebDriverException(
+            f"browser doesn't respond after {BROWSER_LAUNCH_ATTEMPTS} attempts to launch it"
+        )
+
+    def release(self, driver, broken=False):
+        with self.lock:
+            self.album_counts[driver] += 1
+            album_count = self.album_counts[driver]
+            closed = self.closed
+        if not broken and not closed:
+            if album_count >= self.args.recycle_after:
+                eprint(f"Restarting browser after {album_count} albums...")
+                broken = True
+            elif self.args.max_browser_memory:
+                memory = get_driver_memory_usage(driver)
+                if memory is not None and memory > self.args.max_browser_memory:
+                    eprint(f"Restarting browser using {memory // 1024 ** 2} MiB of memory...")
+                    broken = True
+        if broken or closed:
+            self.retire(driver)
+            # Replacement is only needed, if somebody waits for browser (e.g. deferred albums are
+            # resolved, or daemon gets new jobs) or there are albums left. Browser is retired
+            # before waiters are counted, so acquire either is counted or launches browser itself.
+            with self.lock:
+                waiting = self.waiting_count > 0
+            if waiting or not self.album_url_queue.empty():
+                self.launch_in_background()
+        else:
+            self.idle_drivers.put(driver)
+
+    # Browser is quit in background, because it may take a while
+    def retire(self, driver):
+        with self.lock:
+            del self.album_counts[driver]
+            self.browser_count -= 1
+            thread = threading.Thread(target=quit_driver, args=(driver,))
+            self.threads.append(thread)
+        thread.start()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        for thread in self.threads:
+            thread.join()
+        while True:
+            try:
+                driver = self.idle_drivers.get_nowait()
+            except queue.Empty:
+                break
+            if not isinstance(driver, BaseException):
+                quit_driver(driver)
+
+
+# Any error means, that browser can't be used anymore
+def is_driver_alive(driver):
+    try:
+        driver.current_url
+        return True
+    except Exception:
+        return False
+
+
+def quit_driver(driver):
+    try:
+        driver.quit()
+    except Exception:
+        # Browser may be already dead
+        pass
+
+
+# Memory usage of browser is a sum of resident memory of webdriver service process and all its
+# descendants (browser processes). It is read from /proc, so None is returned on other systems.
+def get_driver_memory_usage(driver):
+    process = getattr(getattr(driver, "service", None), "process", None)
+    if process is None or not os.path.isdir("/proc"):
+        return None
+    children = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # Process name may contain spaces and parentheses, so fields are counted from its end
+                parent_pid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent_pid, []).append(int(pid))
+
+    memory = 0
+    pids = [process.pid]
+    while pids:
+        pid = pids.pop()
+        pids.extend(children.get(pid, ()))
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        memory += int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+    return memory
+
+
+# Minimal browser doesn't load anything, that isn't needed for checkout: images, fonts, media,
+# analytics and other third-party scripts. It also doesn't use cache, extensions and background
+# networking, and lets pages be used as soon as DOM is loaded.
+def create_driver(driver_name, show_browser_window, minimal_browser=False):
+    from selenium import webdriver
+    from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+    from selenium.webdriver.firefox.firefox_profile import FirefoxProfile
+
+    if driver_name is None:
+        driver_name = "chromium"
+    if minimal_browser:
+        capabilities = {"pageLoadStrategy": "eager"}
+    else:
+        capabilities = {}
+    if driver_name in ("chrome", "chromium"):
+        options = webdriver.ChromeOptions()
+        if not show_browser_window:
+            options.add_argument("--headless")
+            options.add_argument("--disable-gpu")
+        options.add_argument("--blink-settings=imagesEnabled=false")
+        if minimal_browser:
+            set_minimal_chrome_options(options, capabilities)
+            return block_urls(webdriver.Chrome(options=options))
+        return webdriver.Chrome(options=options)
+    elif driver_name == "edge":
+        return webdriver.Edge(capabilities={**DesiredCapabilities.EDGE, **capabilities})
+    elif driver_name in ("firefox", "gecko"):
+        profile = FirefoxProfile()
+        profile.set_preference("permissions.default.image", 2)
+        if minimal_browser:
+            for name, value in MINIMAL_FIREFOX_PREFERENCES.items():
+                profile.set_preference(name, value)
+        if not show_browser_window:
+            os.environ["MOZ_HEADLESS"] = "1"
+        return webdriver.Firefox(
+            profile,
+            capabilities={**DesiredCapabilities.FIREFOX, **capabilities},
+            service_log_path=os.devnull,
+        )
+    elif driver_name == "opera":
+        return webdriver.Opera(desired_capabilities={**DesiredCapabilities.OPERA, **capabilities})
+    elif driver_name == "phantomjs":
+        if minimal_browser:
+            return webdriver.PhantomJS(
+                service_args=["--load-images=false", "--disk-cache=false"]
+            )
+        return webdriver.PhantomJS()
+    elif driver_name == "safari":
+        return webdriver.Safari(desired_capabilities={**DesiredCapabilities.SAFARI, **capabilities})
+    elif driver_name == "webkit":
+        return webdriver.WebKitGTK(
+            desired_capabilities={**DesiredCapabilities.WEBKITGTK, **capabilities}
+        )
+
+
+def set_minimal_chrome_options(options, capabilities):
+    for argument in MINIMAL_CHROME_ARGUMENTS:
+        options.add_argument(argument)
+    options.add_experimental_option("prefs", MINIMAL_CHROME_PREFERENCES)
+    for name, value in capabilities.items():
+        options.set_capability(name, value)
+
+
+# Requests are blocked with devtools protocol, which only chromium based browsers support
+def block_urls(driver):
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": list(BLOCKED_URL_PATTERNS)})
+    except (AttributeError, WebDriverException):
+        pass
+    return driver
+
+
+@contextmanager
+def file_lock(lock_file_name):
+    with open(lock_file_name, "a") as f:
+        # There is no fcntl on Windows, where lock is not taken
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# Session is created on first request, so that requests isn't imported, if all albums are skipped
+class LazySession:
+    def __init__(self, *args):
+        self.args = args
+        self.session = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        with self.lock:
+            if self.session is None:
+                self.session = create_session(*self.args)
+        return getattr(self.session, name)
+
+
+def create_session(pool_size, retries, timeout, rate_controller):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # Every request (and every redirect) is paced by rate controller. Throttled requests are
+    # retried, after host is given time to recover.
+    class TimeoutHTTPAdapter(HTTPAdapter):
+        def __init__(self, *args, timeout=None, **kwargs):
+            self.timeout = timeout
+            super().__init__(*args, **kwargs)
+
+        def send(self, request, **kwargs):
+            if kwargs.get("timeout") is None:
+                kwargs["timeout"] = self.timeout
+            for attempt in range(retries + 1):
+                time.sleep(rate_controller.reserve(request.url))
+                r = super().send(request, **kwargs)
+                throttled = r.status_code in THROTTLING_STATUS_CODES or (
+                    r.status_code == 403
+                    and not kwargs.get("stream")
+                    and CHALLENGE_PAGE_TITLE_PATTERN.search(r.text) is not None
+                )
+                rate_controller.report(request.url, throttled, get_retry_after(r.headers))
+                if not throttled or attempt == retries:
+                    return r
+                r.close()
+
+    session = requests.Session()
+    # Connection errors are retried with exponential backoff
+    retry = Retry(total=retries, backoff_factor=1, allowed_methods=("HEAD", "GET"))
+    adapter = TimeoutHTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry, timeout=timeout
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def split_into_segments(total_size, count):
+    segment_size = -(-total_size // count)
+    return [
+        [start, min(start + segment_size, total_size) - 1, 0]
+        for start in range(0, total_size, segment_size)
+    ]
+
+
+# Signed download urls carry their expiry time as unix timestamp either in "e" parameter or at the
+# beginning of "token" parameter
+def get_download_url_expiry(download_url):
+    query = parse_qs(urlparse(download_url).query)
+    if query.get("e", [""])[0].isdigit():
+        return int(query["e"][0])
+    match = re.match(r"(\d{9,})_", query.get("token", [""])[0])
+    if match:
+        return int(match.group(1))
+    return None
+
+
+# Encoding of download url is either its "enc" parameter or one of its path segments
+def get_download_url_encoding(download_url):
+    onsite_encodings = get_onsite_encodings(encodings)
+    parsed_url = urlparse(download_url)
+    for candidate in parse_qs(parsed_url.query).get("enc", []) + parsed_url.path.split("/"):
+        if candidate in onsite_encodings:
+            return candidate
+    return None
+
+
+def get_entry_encoding(entry):
+    try:
+        entry = json.loads(entry)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(entry, dict) or not isinstance(entry.get("download_url"), str):
+        return None
+    return get_download_url_encoding(entry["download_url"])
+
+
+# Only delay in seconds is supported, not http date
+def get_retry_after(headers):
+    retry_after = headers.get("retry-after", "")
+    return float(retry_after) if retry_after.isdigit() else None
+
+
+def get_content_range_total(response):
+    match = re.search(r"/(\d+)$", response.headers.get("content-range", ""))
+    return int(match.group(1)) if match else None
+
+
+# Returns partial download of album from cache and offset to resume single stream download from
+def get_partial_download(cache_entry):
+    partial_download = cache_entry.get("partial_download") or {}
+    part_file_name = partial_download.get("file_name")
+    if not (part_file_name and os.path.exists(part_file_name)):
+        return {}, 0
+    if partial_download.get("segments") is not None:
+        return partial_download, 0
+    # Size of file is used instead of offset from cache, because the latter is not updated if
+    # program was killed
+    return partial_download, os.path.getsize(part_file_name)
+
+
+# If several encodings of album are downloaded, their files are told apart by tags in file names
+def get_local_file_name(download_dir, content_disposition_header, file_name_tag=None):
+    file_name = get_on_server_file_name(content_disposition_header)
+    if file_name_tag is not None:
+        base_name, extension = os.path.splitext(file_name)
+        file_name = f"{base_name} ({file_name_tag}){extension}"
+    return os.path.join(download_dir, file_name)
+
+
+def get_on_server_file_name(content_disposition_header):
+    return unquote(re.findall(
+        "filename\*=UTF-8''(.+)", content_disposition_header
+    )[0])
+
+
+def get_cover_file_name(local_file_name):
+    base_name, _ = os.path.splitext(local_file_name)
+    return base_name + ".jpg"
+
+
+# Returns False if file exists and shouldn't be overwritten
+def check_local_file(local_file_name, dont_skip_if_file_exists):
+    local_file_exists = os.path.exists(local_file_name)
+    if local_file_exists and not dont_skip_if_file_exists:
+        eprint(
+            f"File, which wasn't downloaded by this program, exists in '{local_file_name}'.",
+            "Skipping scraping and downloading.",
+            "Rerun program with --dont-skip-if-file-exists to download and overwrite this file.",
+        )
+        return False
+    if local_file_exists:
+        eprint(f"Overwriting '{local_file_name}', because --dont-skip-if-file-exists flag provided.")
+    return True
+
+
+def check_cover_file(cover_file_name, dont_skip_if_file_exists):
+    eprint(f"Downloading cover to '{cover_file_name}'...")
+    cover_file_exists = os.path.exists(cover_file_name)
+    if cover_file_exists and not dont_skip_if_file_exists:
+        eprint(
+            f"Cover image file (probably not downloaded by this program) already exists in '{cover_file_name}'.",
+            "Rerun program with --dont-skip-if-file-exists to download and overwrite this file.",
+        )
+        return False
+    if cover_file_exists:
+        eprint(f"Overwriting '{cover_file_name}', because --dont-skip-if-file-exists flag provided.")
+    return True
+
+
+def get_onsite_encoding(encoding):
+    if encoding is not None:
+        if encoding == "mp3":
+            onsite_encoding = "mp3-320"
+        elif encoding == "mp3v0":
+            onsite_encoding = "mp3-v0"
+        elif encoding == "ogg":
+            onsite_encoding = "vorbis"
+        elif encoding == "aac":
+            onsite_encoding = "aac-hi"
+        elif encoding == "aiff":
+            onsite_encoding = "aiff-lossless"
+        else:
+            onsite_encoding = encoding
+    else:
+        onsite_encoding = None
+    return onsite_encoding
+
+
+# Default encoding is represented by None
+def get_onsite_encodings(encodings):
+    if not encodings:
+        return [None]
+    return [get_onsite_encoding(encoding) for encoding in encodings]
+
+
+# Bandcamp pages keep their data as html-escaped json in attributes like data-tralbum
+def parse_data_attribute(page, attribute_name):
+    match = re.search(f'{attribute_name}="([^"]*)"', page)
+    if match is None:
+        return None
+    return json.loads(unescape(match.group(1)))
+
+
+# Download page asks bandcamp to prepare download and polls its status, until link to the
+# archive is ready
+def wait_for_prepared_download(session, url, timeout, preparing_wait_time):
+    stat_url = url.replace("/download/", "/statdownload/", 1)
+    params = {".vrs": 1}
+    deadline = time.monotonic() + preparing_wait_time
+    while True:
+        r = session.get(stat_url, params=params, timeout=timeout)
+        r.raise_for_status()
+        # Response is either json object or a javascript callback call with it as an argument
+        match = re.search(r"statResult\s*\(\s*(\{.*\})\s*\)", r.text, re.DOTALL) or re.fullmatch(
+            r"\s*(\{.*\})\s*", r.text, re.DOTALL
+        )
+        if match is None:
+            return None
+        stat = json.loads(match.group(1))
+        if stat.get("result") == "ok" and stat.get("download_url"):
+            return stat["download_url"]
+        if stat.get("retry_url"):
+            # Retry url already has all needed parameters
+            stat_url = stat["retry_url"]
+            params = None
+        if time.monotonic() > deadline:
+            eprint("Bandcamp hasn't prepared download in time.")
+            return None
+        time.sleep(1)
+
+
+def read_album_urls(input_file):
+    if input_file == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(input_file) as f:
+            lines = f.readlines()
+    # Empty lines and comments are skipped
+    return [line.strip() for line in lines if line.strip() and not line.lstrip().startswith("#")]
+
+
+def deduplicate_album_urls(album_urls):
+    seen = set()
+    result = []
+    for album_url in album_urls:
+        normalized_url = remove_url_query_parameters(album_url)
+        if normalized_url not in seen:
+            seen.add(normalized_url)
+            result.append(album_url)
+    return result
+
+
+def parse_encodings(s):
+    parsed_encodings = []
+    for encoding in s.split(","):
+        if encoding not in encodings:
+            raise argparse.ArgumentTypeError(
+                f"invalid encoding: '{encoding}' (choose from {', '.join(encodings)})"
+            )
+        if encoding not in parsed_encodings:
+            parsed_encodings.append(encoding)
+    return parsed_encodings
+
+
+def parse_size(s):
+    multipliers = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    try:
+        if s[-1:].upper() in multipliers:
+            return int(float(s[:-1]) * multipliers[s[-1].upper()])
+        return int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: '{s}'")
+
+
+def is_url(s):
+    return urlparse(s).scheme in ("http", "https")
 
 
 def remove_url_query_parameters(url):
     return urljoin(url, urlparse(url).path)
 
 
+# Exception can only come from requests, if it was imported
+def is_request_exception(e):
+    requests = sys.modules.get("requests")
+    return isinstance(e, IncompleteDownload) or (
+        requests is not None and isinstance(e, requests.RequestException)
+    )
+
+
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
+# Unexpected errors fail only the album they occurred for, so that workers keep processing others
+def print_unexpected_error(album_url):
+    eprint(f"Unexpected error while processing '{album_url}':")
+    traceback.print_exc()
+
+
 def ask_yes_no(question_string):
     eprint(question_string, "(Y/n)", end=" ")
     return input()[0] in ("Y", "y")
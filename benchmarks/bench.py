@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+# Benchmarks of bandcamp_name_your_price_dl, which don't touch the network. Cache is benchmarked
+# directly, everything else is measured by running the program against local fixture server.
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+SCRIPT = os.path.join(ROOT_DIR, "bandcamp_name_your_price_dl.py")
+sys.path.insert(0, ROOT_DIR)
+
+from fixture_server import parse_size, start_server  # noqa: E402
+
+BENCHMARKS = ("startup", "cache", "index", "download", "batch")
+# Modules, which must not be imported by runs needing neither browser nor network
+LAZY_MODULES = (
+    "selenium.webdriver",
+    "requests",
+    "urllib3",
+    "asyncio",
+    "aiohttp",
+    "http.server",
+)
+
+
+# Directory with cache and downloads of the last run of program
+work_dir = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of bandcamp_name_your_price_dl")
+    parser.add_argument(
+        "benchmarks",
+        metavar="BENCHMARK",
+        nargs="*",
+        help=f"benchmarks to run ({', '.join(BENCHMARKS)}) (default is all of them)",
+    )
+    parser.add_argument(
+        "--startup-runs",
+        metavar="N",
+        type=int,
+        default=10,
+        help="number of runs, median time of which is reported in startup benchmark (default is"
+        " 10)",
+    )
+    parser.add_argument(
+        "--cache-sizes",
+        metavar="N,N,...",
+        type=lambda s: [int(n) for n in s.split(",")],
+        default=[10000, 100000],
+        help="numbers of cache entries to benchmark cache with (default is 10000,100000)",
+    )
+    parser.add_argument(
+        "--cache-operations",
+        metavar="N",
+        type=int,
+        default=1000,
+        help="number of lookups and writes timed for every cache size (default is 1000)",
+    )
+    parser.add_argument(
+        "--library-files",
+        metavar="N",
+        type=int,
+        default=50000,
+        help="number of files in library of index benchmark (default is 50000)",
+    )
+    parser.add_argument(
+        "--file-size",
+        metavar="BYTES",
+        type=parse_size,
+        default=parse_size("256M"),
+        help="size of file in download benchmark (default is 256M)",
+    )
+    parser.add_argument(
+        "--albums",
+        metavar="N",
+        type=int,
+        default=20,
+        help="number of albums in batch benchmark (default is 20)",
+    )
+    parser.add_argument(
+        "--album-size",
+        metavar="BYTES",
+        type=parse_size,
+        default=parse_size("4M"),
+        help="size of every album in batch benchmark (default is 4M)",
+    )
+    parser.add_argument(
+        "--latency",
+        metavar="SECONDS",
+        type=float,
+        default=0.05,
+        help="delay of every page and api response of fixture server (default is 0.05)",
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        metavar="N",
+        type=float,
+        default=20,
+        help="number of requests per second, above which fixture server throttles requests in"
+        " throttled batch benchmark (default is 20)",
+    )
+    parser.add_argument(
+        "--browser",
+        action="store_true",
+        help="scrape name your price albums in browser in batch benchmark instead of resolving"
+        " free albums with http requests (requires a webdriver)",
+    )
+    parser.add_argument(
+        "--driver",
+        type=str,
+        help="webdriver passed to program with --browser",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        metavar="FILE",
+        type=str,
+        help="write results to file as json, so that they can be compared between versions",
+    )
+    parser.add_argument(
+        "--verbose",
+        "-v",
+        action="store_true",
+        help="show output of program",
+    )
+    args = parser.parse_args()
+    for benchmark in args.benchmarks:
+        if benchmark not in BENCHMARKS:
+            parser.error(f"unknown benchmark: '{benchmark}'")
+
+    results = []
+    for benchmark in args.benchmarks or BENCHMARKS:
+        print(f"== {benchmark}")
+        results.extend(globals()[f"benchmark_{benchmark}"](args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    regressions = [result for result in results if result.get("regression")]
+    for result in regressions:
+        print(f"Regression in {result['name']}: {result['regression']}", file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+def report(results, name, **values):
+    print(f"{name}: " + ", ".join(f"{key} {format_value(value)}" for key, value in values.items()))
+    results.append({"name": name, **values})
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    return str(value)
+
+
+# Runs, which finish without browser and network, are timed: printing help, skipping already
+# downloaded album and printing download url from cache. Modules imported by them are listed with
+# -X importtime, and importing any of LAZY_MODULES is reported as a regression.
+def benchmark_startup(args):
+    results = []
+    server = start_server(1024 * 1024, latency=0)
+    album_urls = [f"{server.base_url}/album/free-startup"]
+    try:
+        run_program(args, album_urls, [])
+        for name, options in (
+            ("help", ["--help"]),
+            ("file exists", []),
+            ("print url from cache", ["--print-url"]),
+        ):
+            durations = sorted(
+                run_program(args, album_urls, options, rerun=True)["duration"]
+                for _ in range(args.startup_runs)
+            )
+            run = run_program(
+                args, album_urls, options, rerun=True, python_options=["-X", "importtime"]
+            )
+            import_time = 0
+            imported_modules = set()
+            for line in run["stderr"].splitlines():
+                if line.startswith("import time:") and "|" in line:
+                    self_time, _, module = line[len("import time:"):].split("|")
+                    if self_time.strip().isdigit():
+                        import_time += int(self_time)
+                        imported_modules.add(module.strip())
+            lazy_modules = [module for module in LAZY_MODULES if module in imported_modules]
+            report(
+                results,
+                f"startup {name}",
+                exit_code=run["exit_code"],
+                median_ms=durations[len(durations) // 2] * 1000,
+                import_ms=import_time / 1000,
+                modules=len(imported_modules),
+            )
+            if lazy_modules:
+                results[-1]["regression"] = f"imports {', '.join(lazy_modules)}"
+    finally:
+        server.shutdown()
+    return results
+
+
+# Lookups and writes are timed on cache filled with entries of already downloaded albums
+def benchmark_cache(args):
+    results = []
+    for size in args.cache_sizes:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            os.environ["XDG_CACHE_HOME"] = cache_dir
+            import bandcamp_name_your_price_dl as bnyp
+
+            album_urls = [f"https://artist{i}.bandcamp.com/album/album-{i}" for i in range(size)]
+            cache = bnyp.Cache(False)
+            start_time = time.monotonic()
+            with cache.transaction():
+                cache.connection.executemany(
+                    "INSERT OR REPLACE INTO albums VALUES (?, '', ?)",
+                    [
+                        (album_url, json.dumps(make_cache_entry(album_url)))
+                        for album_url in album_urls
+                    ],
+                )
+            fill_time = time.monotonic() - start_time
+            cache.connection.close()
+
+            start_time = time.monotonic()
+            cache = bnyp.Cache(False)
+            open_time = time.monotonic() - start_time
+
+            sample = random.sample(album_urls, min(args.cache_operations, size))
+            start_time = time.monotonic()
+            entries = [cache.get_entry(album_url) for album_url in sample]
+            lookup_time = time.monotonic() - start_time
+
+            start_time = time.monotonic()
+            for i in range(len(sample)):
+                cache.get_entry(f"https://missing.bandcamp.com/album/album-{i}")
+            miss_time = time.monotonic() - start_time
+
+            start_time = time.monotonic()
+            for entry in entries:
+                cache.write(entry, download_url_obtained_at=time.time())
+            write_time = time.monotonic() - start_time
+            cache.connection.close()
+
+            report(
+                results,
+                f"cache {size} entries",
+                fill_s=fill_time,
+                open_ms=open_time * 1000,
+                lookup_us=lookup_time / len(sample) * 1e6,
+                miss_us=miss_time / len(sample) * 1e6,
+                write_us=write_time / len(sample) * 1e6,
+            )
+    return results
+
+
+def make_cache_entry(album_url):
+    name = album_url.rsplit("/", 1)[-1]
+    return {
+        "album_url": album_url,
+        "download_url": f"https://p4.bcbits.com/download/album/{name}?e=4102444800",
+        "download_url_obtained_at": 1600000000,
+        "download_url_expires_at": 4102444800,
+        "local_file_name": f"/music/Artist - {name}.zip",
+        "partial_download": None,
+    }
+
+
+# Library index is built for a library of albums, each of which is a directory with tracks and an
+# archive, downloaded by program. Then it is updated without changes, and after some archives were
+# moved and renamed.
+def benchmark_index(args):
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        os.environ["XDG_CACHE_HOME"] = cache_dir
+        import bandcamp_name_your_price_dl as bnyp
+
+        library_dir = os.path.join(cache_dir, "library")
+        album_count = max(args.library_files // 12, 1)
+        album_urls = [f"https://artist{i}.bandcamp.com/album/album-{i}" for i in range(album_count)]
+        cache = bnyp.Cache(False)
+        for i, album_url in enumerate(album_urls):
+            album_dir = os.path.join(library_dir, f"Artist {i % 100}", f"Album {i}")
+            os.makedirs(album_dir)
+            for track in range(1, 11):
+                with open(os.path.join(album_dir, f"{track:02} Track {track}.flac"), "w") as f:
+                    f.write(str(track))
+            with open(os.path.join(album_dir, "cover.jpg"), "w"):
+                pass
+            local_file_name = os.path.join(album_dir, f"Album {i}.zip")
+            # Archives have different sizes, as real ones do, so that renamed ones are found
+            with open(local_file_name, "w") as f:
+                f.write("0" * (1024 + i))
+            cache.add_file(local_file_name, album_url)
+        # Albums downloaded outside of library, which are moved there after it was indexed
+        download_dir = os.path.join(cache_dir, "downloads")
+        os.makedirs(download_dir)
+        downloaded_album_urls = [
+            f"https://artist{i}.bandcamp.com/album/downloaded-{i}" for i in range(10)
+        ]
+        for i, album_url in enumerate(downloaded_album_urls):
+            local_file_name = os.path.join(download_dir, f"Downloaded {i}.zip")
+            with open(local_file_name, "w") as f:
+                f.write("1" * (512 + i))
+            cache.add_file(local_file_name, album_url)
+
+        timings = {}
+        for name, change in (
+            ("build", None),
+            ("update without changes", None),
+            ("update after moving 10 albums", "move"),
+            ("update after renaming 10 albums", "rename"),
+            ("update after moving 10 downloaded albums into library", "import"),
+        ):
+            checked_album_urls = downloaded_album_urls if change == "import" else album_urls[:10]
+            for album_url in checked_album_urls if change else ():
+                local_file_name = cache.find_file(album_url)
+                if change == "rename":
+                    new_file_name = local_file_name + ".renamed"
+                else:
+                    new_file_name = os.path.join(library_dir, os.path.basename(local_file_name))
+                os.rename(local_file_name, new_file_name)
+            start_time = time.monotonic()
+            bnyp.update_file_index(cache, [library_dir])
+            timings[name] = time.monotonic() - start_time
+            found = sum(cache.find_file(album_url) is not None for album_url in checked_album_urls)
+            report(results, f"index {name}", files=args.library_files, duration_s=timings[name])
+            if found != 10:
+                results[-1]["regression"] = f"only {found} of 10 albums are found"
+
+        sample = random.sample(album_urls, min(args.cache_operations, album_count))
+        start_time = time.monotonic()
+        for album_url in sample:
+            cache.find_file(album_url)
+        report(
+            results,
+            "index lookup",
+            files=args.library_files,
+            lookup_us=(time.monotonic() - start_time) / len(sample) * 1e6,
+        )
+        cache.connection.close()
+    return results
+
+
+# Single big file is downloaded by every download engine, and then it is hashed and extracted
+# while being downloaded
+def benchmark_download(args):
+    results = []
+    server = start_server(args.file_size, latency=args.latency, valid_archives=True)
+    try:
+        for name, options in (
+            ("single connection", []),
+            ("4 connections", ["--connections", "4"]),
+            ("async", ["--async-downloads"]),
+            ("of two encodings", ["--encoding", "flac,mp3"]),
+            ("with checksum", ["--checksum", "sha256"]),
+            ("with checksum and extracting", ["--checksum", "sha256", "--extract"]),
+            (
+                "4 connections with checksum and extracting",
+                ["--connections", "4", "--checksum", "sha256", "--extract"],
+            ),
+        ):
+            run = run_program(args, [f"{server.base_url}/album/free-download"], options)
+            metrics = run["metrics"][0] if run["metrics"] else {}
+            report(
+                results,
+                f"download {name}",
+                exit_code=run["exit_code"],
+                wall_s=run["duration"],
+                download_s=metrics.get("stages", {}).get("download"),
+                throughput_mib_s=(metrics.get("throughput") or 0) / 1024 ** 2,
+            )
+    finally:
+        server.shutdown()
+    return results
+
+
+# Many small albums are processed with different numbers of scrapers and downloaders. Last run
+# goes over already downloaded albums, which are only looked up in cache and skipped.
+def benchmark_batch(args):
+    results = []
+    album_type = "nyp" if args.browser else "free"
+    browser_options = []
+    if args.browser:
+        browser_options = ["--browser-only"]
+        if args.driver:
+            browser_options += ["--driver", args.driver]
+
+    server = start_server(args.album_size, latency=args.latency)
+    album_urls = [f"{server.base_url}/album/{album_type}-batch-{i}" for i in range(args.albums)]
+    try:
+        for name, options in (
+            ("1 job, 1 download job", ["--jobs", "1", "--download-jobs", "1"]),
+            ("4 jobs, 2 download jobs", ["--jobs", "4", "--download-jobs", "2"]),
+            ("8 jobs, 4 download jobs", ["--jobs", "8", "--download-jobs", "4"]),
+            ("8 jobs, async downloads", ["--jobs", "8", "--async-downloads"]),
+        ):
+            run = run_program(args, album_urls, options + browser_options)
+            report_batch(results, f"batch {name}", run, len(album_urls))
+        run = run_program(args, album_urls, ["--jobs", "4"] + browser_options, rerun=True)
+        report_batch(results, "batch rerun over downloaded albums", run, len(album_urls))
+        # Downloaded albums are moved away from download directory and found in library index
+        download_dir = os.path.join(work_dir, "downloads")
+        library_dir = os.path.join(download_dir, "library")
+        os.makedirs(library_dir)
+        for file_name in os.listdir(download_dir):
+            if file_name != "library":
+                os.rename(os.path.join(download_dir, file_name), os.path.join(library_dir, file_name))
+        run = run_program(
+            args,
+            album_urls,
+            ["--jobs", "4", "--library", library_dir] + browser_options,
+            rerun=True,
+        )
+        report_batch(results, "batch rerun over moved albums in library", run, len(album_urls))
+        # Albums downloaded after library was indexed are moved there too
+        late_album_urls = [
+            f"{server.base_url}/album/{album_type}-late-batch-{i}" for i in range(args.albums)
+        ]
+        library_options = ["--jobs", "4", "--library", library_dir] + browser_options
+        run_program(args, late_album_urls, library_options, rerun=True)
+        for file_name in os.listdir(download_dir):
+            if file_name != "library":
+                os.rename(os.path.join(download_dir, file_name), os.path.join(library_dir, file_name))
+        run = run_program(args, late_album_urls, library_options, rerun=True)
+        report_batch(
+            results, "batch rerun over albums moved into indexed library", run, len(album_urls)
+        )
+    finally:
+        server.shutdown()
+
+    # Program has to adapt its request rate to rate accepted by server
+    server = start_server(args.album_size, latency=args.latency, throttle_rate=args.throttle_rate)
+    album_urls = [f"{server.base_url}/album/{album_type}-batch-{i}" for i in range(args.albums)]
+    try:
+        run = run_program(
+            args,
+            album_urls,
+            ["--jobs", "8"] + browser_options,
+        )
+        report_batch(results, "batch 8 jobs against throttling server", run, len(album_urls))
+        results[-1]["throttled_requests"] = server.throttled_count
+    finally:
+        server.shutdown()
+    return results
+
+
+def report_batch(results, name, run, album_count):
+    succeeded = sum(metrics["outcome"] == "SUCCESS" for metrics in run["metrics"])
+    report(
+        results,
+        name,
+        exit_code=run["exit_code"],
+        succeeded=succeeded,
+        wall_s=run["duration"],
+        albums_per_s=album_count / run["duration"],
+    )
+    # Reruns should find every album already downloaded
+    if "rerun" in name:
+        downloaded = sum("download" in metrics.get("stages", {}) for metrics in run["metrics"])
+        if downloaded:
+            results[-1]["regression"] = f"{downloaded} albums are downloaded again"
+
+
+# Program is run with fresh cache and download directory, unless it is a rerun of the previous
+# run, which reuses them
+def run_program(args, album_urls, options, rerun=False, python_options=()):
+    global work_dir
+    if not rerun:
+        if work_dir is not None:
+            shutil.rmtree(work_dir)
+        work_dir = tempfile.mkdtemp(prefix="bandcamp_name_your_price_dl_bench_")
+    download_dir = os.path.join(work_dir, "downloads")
+    metrics_file = os.path.join(work_dir, "metrics.jsonl")
+    os.makedirs(download_dir, exist_ok=True)
+    if os.path.exists(metrics_file):
+        os.remove(metrics_file)
+
+    start_time = time.monotonic()
+    process = subprocess.run(
+        [sys.executable, *python_options, SCRIPT, *album_urls, download_dir]
+        + ["--metrics-file", metrics_file]
+        + options,
+        env=dict(os.environ, XDG_CACHE_HOME=os.path.join(work_dir, "cache")),
+        stdin=subprocess.DEVNULL,
+        stdout=None if args.verbose else subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if args.verbose:
+        sys.stderr.write(process.stderr)
+    duration = time.monotonic() - start_time
+
+    metrics = []
+    if os.path.exists(metrics_file):
+        with open(metrics_file) as f:
+            metrics = [json.loads(line) for line in f]
+    return {
+        "exit_code": process.returncode,
+        "duration": duration,
+        "metrics": metrics,
+        "stderr": process.stderr,
+    }
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir)
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# Local stand-in for bandcamp, which serves everything bandcamp_name_your_price_dl needs, so that
+# it can be benchmarked without touching the network:
+#   /album/free-<name>    album with direct free download
+#   /album/nyp-<name>     name your price album, which is bought for 0 in a dialog
+#   /album/paid-<name>    album with minimum price
+#   /download?id=<name>   download page, which is opened after checkout
+#   /statdownload/...     status of download preparing
+#   /cdn/<name>.zip       archive with content-disposition header and range requests support
+# With --throttle-rate server responds with 429 to requests exceeding the rate, and with
+# --email-gate name your price dialog asks for email, like bandcamp does at scale.
+# Archives are generated on the fly, so files of any size can be served without disk space. They
+# are only valid zip archives (of ten tracks), if server is started with --valid-archives, in which
+# case archive is built in memory.
+
+import argparse
+import collections
+import html
+import io
+import json
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import zipfile
+from urllib.parse import parse_qs, quote, urlparse
+
+PATTERN = bytes(range(256)) * 4096
+ENCODINGS = ("mp3-320", "mp3-v0", "flac", "aac-hi", "vorbis", "alac", "wav", "aiff-lossless")
+# Far in the future, so that download urls are never considered expired
+EXPIRES_AT = 4102444800
+
+ALBUM_PAGE = """<!DOCTYPE html>
+<html>
+<head><title>{name}</title></head>
+<body>
+<script data-tralbum="{tralbum}"></script>
+<div id="tralbumArt"><a class="popupImage" href="{base_url}/cover/{name}_10.jpg">cover</a></div>
+<table id="track_table"><tr><td>Track 1</td></tr></table>
+{buy_block}
+</body>
+</html>
+"""
+
+FREE_BUY_BLOCK = """<button class="download-link buy-link" onclick="location.href='{download_page}'"
+>Free Download</button>"""
+
+NYP_BUY_BLOCK = """<span class="buyItemExtra buyItemNyp secondaryText">{price_text}</span>
+<button class="download-link buy-link" id="buy"
+ onclick="document.getElementById('dialog').style.display = 'block'">Buy Digital Album</button>
+<div id="dialog" style="display: none">
+  <input class="display-price numeric" value="7"
+   oninput="document.getElementById('free').style.display = this.value === '0' ? 'inline' : 'none'">
+  <a class="download-panel-free-download-link" id="free" href="#" style="display: none"
+   onclick="document.getElementById('checkout').style.display = 'block'; return false;"
+  >download to your computer</a>
+  <div id="checkout" style="display: none">
+    <input id="fan_email_address" style="display: {email_display}">
+    <select id="fan_email_country"><option value="US">US</option></select>
+    <input id="fan_email_postalcode" style="display: {email_display}">
+    <button class="download-panel-checkout-button"
+     onclick="setTimeout(function () {{ location.href = '{download_page}'; }}, {checkout_delay})"
+    >Download Now</button>
+  </div>
+</div>"""
+
+DOWNLOAD_PAGE = """<!DOCTYPE html>
+<html>
+<head><title>Download {name}</title></head>
+<body>
+<div id="pagedata" data-blob="{blob}"></div>
+<select id="format-type" onchange="chooseEncoding(this.value)">{options}</select>
+<div id="post-checkout-info">
+  <div>
+    <div></div>
+    <div>
+      <div></div><div></div><div></div>
+      <div><a id="link" href="{file_url}" style="display: none">Download</a></div>
+    </div>
+  </div>
+</div>
+<script>
+// Link to chosen encoding is shown, after download of it is prepared
+function chooseEncoding(encoding) {{
+  var link = document.getElementById("link");
+  link.style.display = "none";
+  setTimeout(function () {{
+    link.href = link.href.replace(/enc=[^&]*/, "enc=" + encoding);
+    link.style.display = "inline";
+  }}, {preparing_delay});
+}}
+chooseEncoding("{default_encoding}");
+</script>
+</body>
+</html>
+"""
+
+
+class FixtureServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        file_size,
+        latency=0.0,
+        preparing_polls=1,
+        preparing_delay=0.5,
+        valid_archives=False,
+        throttle_rate=None,
+        email_gate=False,
+    ):
+        super().__init__(address, FixtureRequestHandler)
+        self.archive = make_archive(file_size) if valid_archives else None
+        self.file_size = len(self.archive) if valid_archives else file_size
+        self.latency = latency
+        self.preparing_polls = preparing_polls
+        self.preparing_delay = preparing_delay
+        self.throttle_rate = throttle_rate
+        self.email_gate = email_gate
+        self.lock = threading.Lock()
+        self.poll_counts = {}
+        # Times of requests accepted during last second
+        self.request_times = collections.deque()
+        self.throttled_count = 0
+        self.base_url = f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def count_poll(self, key):
+        with self.lock:
+            self.poll_counts[key] = self.poll_counts.get(key, 0) + 1
+            return self.poll_counts[key]
+
+    def accept_request(self):
+        if self.throttle_rate is None:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            while self.request_times and self.request_times[0] < now - 1:
+                self.request_times.popleft()
+            if len(self.request_times) >= self.throttle_rate:
+                self.throttled_count += 1
+                return False
+            self.request_times.append(now)
+            return True
+
+
+class FixtureRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def do_GET(self):
+        self.handle_request(head=False)
+
+    def handle_request(self, head):
+        server = self.server
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if not server.accept_request():
+            return self.send_body(
+                b"Too many requests", "text/plain", head, status=429, headers={"Retry-After": "1"}
+            )
+        if not url.path.startswith("/cdn/"):
+            # Pages and api calls are slowed down to look like remote ones, file transfers aren't
+            time.sleep(server.latency)
+
+        match = re.fullmatch(r"/album/(free|nyp|paid)-([\w.-]+)", url.path)
+        if match:
+            return self.send_album_page(*match.groups(), head)
+        if url.path == "/download" and "id" in query:
+            return self.send_download_page(query["id"][0], head)
+        if url.path.startswith("/statdownload/") and "id" in query:
+            return self.send_download_status(query, head)
+        match = re.fullmatch(r"/cdn/([\w.-]+)\.zip", url.path)
+        if match:
+            return self.send_file(match.group(1), head)
+        if url.path.startswith("/cover/"):
+            return self.send_body(PATTERN[:64 * 1024], "image/jpeg", head)
+        self.send_body(b"Not found", "text/plain", head, status=404)
+
+    def send_album_page(self, album_type, name, head):
+        server = self.server
+        download_page = f"{server.base_url}/download?id={quote(name)}"
+        tralbum = {
+            "item_type": "album",
+            "current": {"minimum_price": 7.0 if album_type == "paid" else 0.0},
+            "freeDownloadPage": download_page if album_type == "free" else None,
+        }
+        if album_type == "free":
+            buy_block = FREE_BUY_BLOCK.format(download_page=download_page)
+        else:
+            buy_block = NYP_BUY_BLOCK.format(
+                price_text="name your price" if album_type == "nyp" else "USD or more",
+                download_page=download_page,
+                checkout_delay=int(server.latency * 1000),
+                email_display="inline" if server.email_gate else "none",
+            )
+        page = ALBUM_PAGE.format(
+            name=html.escape(name),
+            tralbum=html.escape(json.dumps(tralbum)),
+            base_url=server.base_url,
+            buy_block=buy_block,
+        )
+        self.send_body(page.encode(), "text/html; charset=utf-8", head)
+
+    def send_download_page(self, name, head):
+        server = self.server
+        blob = {
+            "digital_items": [
+                {
+                    "downloads": {
+                        encoding: {
+                            "url": f"{server.base_url}/download/album?enc={encoding}"
+                            f"&id={quote(name)}"
+                        }
+                        for encoding in ENCODINGS
+                    }
+                }
+            ]
+        }
+        page = DOWNLOAD_PAGE.format(
+            name=html.escape(name),
+            blob=html.escape(json.dumps(blob)),
+            options="".join(
+                f'<option value="{encoding}">{encoding}</option>' for encoding in ENCODINGS
+            ),
+            file_url=html.escape(self.get_file_url(name, ENCODINGS[0])),
+            preparing_delay=int(server.preparing_delay * 1000),
+            default_encoding=ENCODINGS[0],
+        )
+        self.send_body(page.encode(), "text/html; charset=utf-8", head)
+
+    # Download is reported as ready only after a few polls, like bandcamp does for big albums
+    def send_download_status(self, query, head):
+        server = self.server
+        name = query["id"][0]
+        encoding = query.get("enc", [ENCODINGS[0]])[0]
+        polls = server.count_poll((name, encoding))
+        if polls >= server.preparing_polls:
+            stat = {"result": "ok", "download_url": self.get_file_url(name, encoding)}
+        else:
+            stat = {"result": "err", "retry_url": f"{server.base_url}{self.path}"}
+        body = f"if ( window.Downloads ) {{ Downloads.statResult ( {json.dumps(stat)} ) }};"
+        self.send_body(body.encode(), "text/javascript", head)
+
+    def send_file(self, name, head):
+        file_size = self.server.file_size
+        start, end = 0, file_size - 1
+        status = 200
+        headers = {
+            "Content-Disposition": f"attachment; filename*=UTF-8''{quote(f'Artist - {name}.zip')}",
+            "Accept-Ranges": "bytes",
+        }
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), file_size - 1)
+            if start >= file_size:
+                headers["Content-Range"] = f"bytes */{file_size}"
+                return self.send_body(b"", "text/plain", head, status=416, headers=headers)
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(end + 1 - start))
+        for header_name, value in headers.items():
+            self.send_header(header_name, value)
+        self.end_headers()
+        if head:
+            return
+        position = start
+        try:
+            if self.server.archive is not None:
+                self.wfile.write(memoryview(self.server.archive)[start : end + 1])
+                return
+            while position <= end:
+                offset = position % len(PATTERN)
+                chunk = PATTERN[offset:][: end + 1 - position]
+                self.wfile.write(chunk)
+                position += len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def send_body(self, body, content_type, head, status=200, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for header_name, value in (headers or {}).items():
+            self.send_header(header_name, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    # Files of all encodings have the same name, like on bandcamp
+    def get_file_url(self, name, encoding):
+        return f"{self.server.base_url}/cdn/{quote(name)}.zip?enc={encoding}&e={EXPIRES_AT}"
+
+
+# Tracks are stored uncompressed, like in archives of bandcamp
+def make_archive(size):
+    buffer = io.BytesIO()
+    track_size = size // 10
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for i in range(1, 11):
+            data = (PATTERN * (track_size // len(PATTERN) + 1))[:track_size]
+            archive.writestr(f"Artist - Album - {i:02} Track {i}.flac", data)
+        archive.writestr("cover.jpg", PATTERN[: 64 * 1024])
+    return buffer.getvalue()
+
+
+# Starts server in a background thread. Port 0 means any free port.
+def start_server(file_size, port=0, **kwargs):
+    server = FixtureServer(("127.0.0.1", port), file_size, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_size(s):
+    multipliers = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if s[-1:].upper() in multipliers:
+        return int(float(s[:-1]) * multipliers[s[-1].upper()])
+    return int(s)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for bandcamp")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on (default is 8000)")
+    parser.add_argument(
+        "--file-size",
+        metavar="BYTES",
+        type=parse_size,
+        default=parse_size("64M"),
+        help="size of served archives (K, M and G suffixes are supported) (default is 64M)",
+    )
+    parser.add_argument(
+        "--latency",
+        metavar="SECONDS",
+        type=float,
+        default=0.05,
+        help="delay of every page and api response (in seconds) (default is 0.05)",
+    )
+    parser.add_argument(
+        "--preparing-polls",
+        metavar="N",
+        type=int,
+        default=2,
+        help="number of status polls, after which download is prepared (default is 2)",
+    )
+    parser.add_argument(
+        "--preparing-delay",
+        metavar="SECONDS",
+        type=float,
+        default=0.5,
+        help="delay of download link appearing on download page (in seconds) (default is 0.5)",
+    )
+    parser.add_argument(
+        "--valid-archives",
+        action="store_true",
+        help="serve valid zip archives instead of generated bytes (archive is kept in memory)",
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        metavar="N",
+        type=float,
+        help="respond with 429 to requests exceeding N requests per second",
+    )
+    parser.add_argument(
+        "--email-gate",
+        action="store_true",
+        help="ask for email in name your price dialog",
+    )
+    args = parser.parse_args()
+
+    server = FixtureServer(
+        ("127.0.0.1", args.port),
+        args.file_size,
+        latency=args.latency,
+        preparing_polls=args.preparing_polls,
+        preparing_delay=args.preparing_delay,
+        valid_archives=args.valid_archives,
+        throttle_rate=args.throttle_rate,
+        email_gate=args.email_gate,
+    )
+    print(f"Serving on {server.base_url}, e.g. {server.base_url}/album/free-example", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
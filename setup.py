@@ -30,5 +30,8 @@ setuptools.setup(
             "bandcamp_name_your_price_dl = bandcamp_name_your_price_dl:main",
         ],
     },
-    install_requires=["selenium", "requests", "pystandardpaths"]
+    install_requires=["selenium", "requests", "urllib3", "pystandardpaths"],
+    extras_require={
+        "async": ["aiohttp"],
+    },
 )
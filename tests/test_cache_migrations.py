@@ -0,0 +1,110 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+import bandcamp_name_your_price_dl as bnyp
+
+ALBUM_URL = "https://artist.bandcamp.com/album/album"
+FLAC_DOWNLOAD_URL = "https://p4.bcbits.com/download/album/0123/flac/456?fsig=789&id=1"
+
+
+@pytest.fixture
+def program_cache_dir(cache_dir):
+    program_cache_dir = cache_dir / "bandcamp_name_your_price_dl"
+    program_cache_dir.mkdir(parents=True)
+    return program_cache_dir
+
+
+# Cache as it was before entries were kept per encoding
+def create_cache_without_encodings(program_cache_dir, entries, files=()):
+    connection = sqlite3.connect(program_cache_dir / "cache.sqlite3")
+    connection.execute(
+        "CREATE TABLE albums (album_url TEXT PRIMARY KEY, entry TEXT NOT NULL)"
+    )
+    connection.execute(
+        "CREATE TABLE files (path TEXT PRIMARY KEY, directory TEXT NOT NULL,"
+        " size INTEGER NOT NULL, mtime REAL NOT NULL, hash TEXT, album_url TEXT)"
+    )
+    connection.executemany(
+        "INSERT INTO albums VALUES (?, ?)",
+        [(entry["album_url"], json.dumps(entry)) for entry in entries],
+    )
+    connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)", files)
+    connection.commit()
+    connection.close()
+
+
+def test_entries_become_entries_of_default_encoding(program_cache_dir):
+    entry = {"album_url": ALBUM_URL, "download_url": "https://example.com/download"}
+    create_cache_without_encodings(program_cache_dir, [entry])
+    cache = bnyp.Cache(False)
+    assert cache.get_entry(ALBUM_URL)["download_url"] == "https://example.com/download"
+    assert cache.connection.execute("SELECT COUNT(*) FROM albums").fetchone() == (1,)
+
+
+# Album downloaded with --encoding is still found in cache with it
+def test_entries_are_copied_to_encoding_of_their_download_url(program_cache_dir):
+    entry = {
+        "album_url": ALBUM_URL,
+        "download_url": FLAC_DOWNLOAD_URL,
+        "local_file_name": "/music/Artist - Album.zip",
+    }
+    create_cache_without_encodings(program_cache_dir, [entry])
+    cache = bnyp.Cache(False)
+    for encoding in (None, "flac"):
+        cached_entry = cache.get_entry(ALBUM_URL, encoding)
+        assert cached_entry["download_url"] == FLAC_DOWNLOAD_URL
+        assert cached_entry["local_file_name"] == "/music/Artist - Album.zip"
+    assert "download_url" not in cache.get_entry(ALBUM_URL, "mp3-320")
+
+
+def test_files_get_default_encoding(program_cache_dir):
+    create_cache_without_encodings(
+        program_cache_dir,
+        [],
+        [("/music/Artist - Album.zip", "/music", 1000, 0.0, None, ALBUM_URL)],
+    )
+    cache = bnyp.Cache(False)
+    assert cache.connection.execute("SELECT album_url, encoding FROM files").fetchall() == [
+        (ALBUM_URL, "")
+    ]
+
+
+def test_migrated_cache_is_not_migrated_again(program_cache_dir):
+    entry = {"album_url": ALBUM_URL, "download_url": FLAC_DOWNLOAD_URL}
+    create_cache_without_encodings(program_cache_dir, [entry])
+    cache = bnyp.Cache(False)
+    cache.write(cache.get_entry(ALBUM_URL, "flac"), file_size=1000)
+    cache.connection.close()
+    cache = bnyp.Cache(False)
+    assert cache.get_entry(ALBUM_URL, "flac")["file_size"] == 1000
+    assert cache.connection.execute("SELECT COUNT(*) FROM albums").fetchone() == (2,)
+
+
+def test_json_cache_is_imported(program_cache_dir):
+    entries = [
+        {"album_url": ALBUM_URL + "?from=discover", "download_url": FLAC_DOWNLOAD_URL},
+        {"album_url": "https://other.bandcamp.com/album/album", "downloadable": False},
+        {"download_url": FLAC_DOWNLOAD_URL},
+        "not an entry",
+    ]
+    json_cache_file = program_cache_dir / "cache.json"
+    json_cache_file.write_text(json.dumps(entries))
+    cache = bnyp.Cache(False)
+    # Entries are keyed by album url without query parameters
+    assert cache.get_entry(ALBUM_URL)["download_url"] == FLAC_DOWNLOAD_URL
+    assert cache.get_entry("https://other.bandcamp.com/album/album")["downloadable"] is False
+    assert cache.connection.execute("SELECT COUNT(*) FROM albums").fetchone() == (2,)
+    assert not json_cache_file.exists()
+    assert os.path.exists(str(json_cache_file) + ".migrated")
+
+
+def test_empty_json_cache_is_renamed(program_cache_dir):
+    json_cache_file = program_cache_dir / "cache.json"
+    json_cache_file.write_text("")
+    cache = bnyp.Cache(False)
+    assert cache.connection.execute("SELECT COUNT(*) FROM albums").fetchone() == (0,)
+    assert not json_cache_file.exists()
+    assert os.path.exists(str(json_cache_file) + ".migrated")
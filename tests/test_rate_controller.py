@@ -0,0 +1,93 @@
+import pytest
+
+import bandcamp_name_your_price_dl as bnyp
+
+URL = "https://artist.bandcamp.com/album/album"
+OTHER_URL = "https://other.bandcamp.com/album/album"
+
+
+# Time doesn't pass, unless test moves clock
+@pytest.fixture
+def clock(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(bnyp.time, "monotonic", lambda: clock[0])
+    return clock
+
+
+def test_requests_are_not_paced_without_max_rate(clock):
+    rate_controller = bnyp.RateController()
+    assert [rate_controller.reserve(URL) for _ in range(10)] == [0] * 10
+
+
+def test_requests_are_paced_per_host(clock):
+    rate_controller = bnyp.RateController(max_rate=10)
+    assert [rate_controller.reserve(URL) for _ in range(3)] == pytest.approx([0, 0.1, 0.2])
+    assert rate_controller.reserve(OTHER_URL) == 0
+    clock[0] += 1
+    assert rate_controller.reserve(URL) == 0
+
+
+def test_throttled_host_is_slowed_down(clock):
+    rate_controller = bnyp.RateController(max_rate=10)
+    rate_controller.reserve(URL)
+    rate_controller.report(URL, True)
+    assert rate_controller.rates["artist.bandcamp.com"] == 5
+    # Nothing is sent to host for a second, and then requests are spaced according to its rate
+    assert rate_controller.reserve(URL) == pytest.approx(1)
+    assert rate_controller.reserve(URL) == pytest.approx(1.2)
+    assert rate_controller.reserve(OTHER_URL) == 0
+
+
+def test_rate_of_unpaced_host_is_measured(clock):
+    rate_controller = bnyp.RateController()
+    for _ in range(8):
+        rate_controller.reserve(URL)
+    rate_controller.report(URL, True)
+    assert rate_controller.rates["artist.bandcamp.com"] == 4
+    assert rate_controller.reserve(URL) == pytest.approx(1)
+
+
+def test_retry_after_is_respected(clock):
+    rate_controller = bnyp.RateController(max_rate=10)
+    rate_controller.report(URL, True, retry_after=30)
+    assert rate_controller.reserve(URL) == pytest.approx(30)
+
+
+# Responses to requests sent before host was slowed down are throttled too
+def test_host_is_slowed_down_once_during_pause(clock):
+    rate_controller = bnyp.RateController(max_rate=10)
+    rate_controller.report(URL, True)
+    rate_controller.report(URL, True)
+    assert rate_controller.rates["artist.bandcamp.com"] == 5
+    clock[0] += 1
+    rate_controller.report(URL, True)
+    assert rate_controller.rates["artist.bandcamp.com"] == 2.5
+
+
+def test_rate_is_not_lowered_below_minimum(clock):
+    rate_controller = bnyp.RateController(max_rate=0.15)
+    for _ in range(5):
+        rate_controller.report(URL, True)
+        clock[0] += 100
+    assert rate_controller.rates["artist.bandcamp.com"] == bnyp.MIN_REQUEST_RATE
+
+
+def test_rate_is_raised_back_by_healthy_responses(clock):
+    rate_controller = bnyp.RateController(max_rate=10)
+    rate_controller.report(URL, True)
+    rate_controller.report(URL, False)
+    assert rate_controller.rates["artist.bandcamp.com"] == 5 + bnyp.REQUEST_RATE_STEP
+    for _ in range(int(5 / bnyp.REQUEST_RATE_STEP)):
+        rate_controller.report(URL, False)
+    # Host is paced according to max rate again
+    assert "artist.bandcamp.com" not in rate_controller.rates
+
+
+def test_rate_of_unpaced_host_is_raised_without_limit(clock):
+    rate_controller = bnyp.RateController()
+    for _ in range(8):
+        rate_controller.reserve(URL)
+    rate_controller.report(URL, True)
+    for _ in range(100):
+        rate_controller.report(URL, False)
+    assert rate_controller.rates["artist.bandcamp.com"] == 4 + 100 * bnyp.REQUEST_RATE_STEP
@@ -0,0 +1,143 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+import bandcamp_name_your_price_dl as bnyp
+
+FILES = {
+    "01 - First.mp3": os.urandom(100000),
+    "02 - Second.mp3": b"second track " * 10000,
+    "Covers/cover.jpg": os.urandom(5000),
+    "empty.txt": b"",
+}
+
+
+# Written zip archive can't be seeked back, so zipfile writes data descriptors after entries
+class UnseekableFile(io.RawIOBase):
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        return len(b)
+
+
+def make_archive(compression, data_descriptors=False, zip64=False):
+    f = UnseekableFile() if data_descriptors else io.BytesIO()
+    with zipfile.ZipFile(f, "w", compression) as archive:
+        for name, data in FILES.items():
+            with archive.open(name, "w", force_zip64=zip64) as entry:
+                entry.write(data)
+    return bytes(f.data) if data_descriptors else f.getvalue()
+
+
+def extract(data, directory, chunk_size):
+    extractor = bnyp.ZipStreamExtractor(directory)
+    for i in range(0, len(data), chunk_size):
+        extractor.feed(data[i : i + chunk_size])
+    return extractor.close()
+
+
+def read_files(directory):
+    files = {}
+    for root, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            with open(path, "rb") as f:
+                files[os.path.relpath(path, directory).replace(os.sep, "/")] = f.read()
+    return files
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096, 1024 * 1024])
+@pytest.mark.parametrize(
+    "compression, data_descriptors, zip64",
+    [
+        (zipfile.ZIP_STORED, False, False),
+        (zipfile.ZIP_DEFLATED, False, False),
+        (zipfile.ZIP_DEFLATED, True, False),
+        (zipfile.ZIP_STORED, False, True),
+        (zipfile.ZIP_DEFLATED, True, True),
+    ],
+)
+def test_archive_is_extracted(tmp_path, compression, data_descriptors, zip64, chunk_size):
+    data = make_archive(compression, data_descriptors, zip64)
+    assert extract(data, tmp_path / "album", chunk_size)
+    assert read_files(tmp_path / "album") == FILES
+
+
+def test_directory_entries_are_created(tmp_path):
+    f = io.BytesIO()
+    with zipfile.ZipFile(f, "w") as archive:
+        archive.writestr("Covers/", b"")
+        archive.writestr("Covers/cover.jpg", b"cover")
+    assert extract(f.getvalue(), tmp_path / "album", 4096)
+    assert read_files(tmp_path / "album") == {"Covers/cover.jpg": b"cover"}
+
+
+# Stored entries with data descriptors can't be read without knowing their size in advance
+def test_stored_entries_with_data_descriptors_are_left_to_fallback(tmp_path):
+    data = make_archive(zipfile.ZIP_STORED, data_descriptors=True)
+    assert not extract(data, tmp_path / "album", 4096)
+
+
+def test_crc_mismatch_fails_extraction(tmp_path):
+    data = bytearray(make_archive(zipfile.ZIP_STORED))
+    data[data.index(FILES["02 - Second.mp3"][:100]) + 50] ^= 0xFF
+    assert not extract(bytes(data), tmp_path / "album", 4096)
+
+
+def test_unsafe_path_fails_extraction(tmp_path):
+    f = io.BytesIO()
+    with zipfile.ZipFile(f, "w") as archive:
+        archive.writestr("../evil.txt", b"evil")
+    assert not extract(f.getvalue(), tmp_path / "album", 4096)
+    assert not (tmp_path / "evil.txt").exists()
+
+
+def test_not_an_archive_fails_extraction(tmp_path):
+    assert not extract(os.urandom(10000), tmp_path / "album", 4096)
+
+
+def test_incomplete_archive_is_not_reported_extracted(tmp_path):
+    data = make_archive(zipfile.ZIP_DEFLATED)
+    assert not extract(data[: len(data) // 2], tmp_path / "album", 4096)
+
+
+# Archive, which can't be extracted while it is being downloaded, is extracted from part file
+@pytest.mark.parametrize("streamed", [True, False])
+def test_stream_processor_falls_back_to_extracting_part_file(tmp_path, streamed):
+    data = make_archive(zipfile.ZIP_STORED, data_descriptors=True)
+    local_file_name = str(tmp_path / "Artist - Album.zip")
+    with open(local_file_name + bnyp.PART_FILE_SUFFIX, "wb") as f:
+        f.write(data)
+    processor = bnyp.StreamProcessor(local_file_name, "sha256", True)
+    if streamed:
+        processor.start(0)
+        processor.update(data)
+    fields = processor.finish()
+    assert fields["file_size"] == len(data)
+    assert fields["file_hash"].startswith("sha256:")
+    assert fields["extract_dir"] == str(tmp_path / "Artist - Album")
+    assert read_files(tmp_path / "Artist - Album") == FILES
+
+
+def test_stream_processor_extracts_while_streaming(tmp_path, monkeypatch):
+    data = make_archive(zipfile.ZIP_DEFLATED, data_descriptors=True)
+    local_file_name = str(tmp_path / "Artist - Album.zip")
+    with open(local_file_name + bnyp.PART_FILE_SUFFIX, "wb") as f:
+        f.write(data)
+    monkeypatch.setattr(bnyp, "extract_zip_file", None)
+    processor = bnyp.StreamProcessor(local_file_name, None, True)
+    processor.start(0)
+    for i in range(0, len(data), 4096):
+        processor.update(data[i : i + 4096])
+    assert processor.finish() == {
+        "file_size": len(data),
+        "extract_dir": str(tmp_path / "Artist - Album"),
+    }
+    assert read_files(tmp_path / "Artist - Album") == FILES